@@ -1,10 +1,9 @@
-from flask import Flask, render_template, request, jsonify, make_response
+from flask import Flask, render_template, request, jsonify, make_response, Response, stream_with_context
 import json
 import torch
-from midigpt import GPT, TetradPlayer, WatermarkLogitsProcessor, WatermarkDetector
+from midigpt import GPT, TetradPlayer, WatermarkLogitsProcessor, WatermarkDetector, StreamingWatermarkDetector
 from midigpt.datasets import BachChoralesEncoder
 # import pathlib
-import os
 app = Flask(__name__)
 
 default_metrics = [
@@ -17,6 +16,12 @@ default_metrics = [
     {"name": "# Tokens in Greenlist", "value": None}
 ]
 
+def read_chords(upload, tempo):
+    # MIDI uploads skip audio decoding entirely
+    if upload.filename.lower().endswith(('.mid', '.midi')):
+        return TetradPlayer.from_midi(upload.stream)
+    return TetradPlayer().from_wav(upload.stream, tempo = tempo)
+
 @app.route('/')
 def index():
     metrics = default_metrics
@@ -28,11 +33,6 @@ def generate_music():
         return jsonify({'error': 'No file uploaded'}), 400
 
     music_file = request.files['music_file']
-
-    # write file to temp
-    with open("/tmp/temp.wav", 'wb') as f:
-        f.write(music_file.read())
-    music_file = "/tmp/temp.wav"
     
     #load model and tokenizer
     model = GPT.from_checkpoint("../projects/bach-chorales/best_model.ckpt", map_location=torch.device("cpu"))
@@ -46,7 +46,7 @@ def generate_music():
 
     print(f"max_tokens: {max_tokens}, tempo: {tempo}, do_sample: {do_sample}, temperature: {temperature}")
     
-    chorale = TetradPlayer().from_wav(music_file, tempo = tempo)
+    chorale = read_chords(music_file, tempo)
     
     seed_notes = encoder.encode(torch.as_tensor(chorale.flatten()))
     
@@ -92,33 +92,64 @@ def generate_music():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/generate_stream', methods=['POST'])
+def generate_stream():
+    if 'music_file' not in request.files:
+        return jsonify({'error': 'No file uploaded'}), 400
+
+    music_file = request.files['music_file']
+
+    model = GPT.from_checkpoint("../projects/bach-chorales/best_model.ckpt", map_location=torch.device("cpu"))
+    encoder = BachChoralesEncoder()
+
+    max_tokens = int(request.form['max_tokens'])
+    tempo = int(request.form['tempo'])
+    temperature = float(request.form['temperature'])
+    watermark_processor = WatermarkLogitsProcessor() if request.form.get('watermark') else None
+
+    chorale = read_chords(music_file, tempo)
+    seed_notes = encoder.encode(torch.as_tensor(chorale.flatten()))
+
+    # one JSON line per completed chord, so the client can start playback and detection on the first chords.
+    # the generation is cancelled when the client disconnects and the generator is closed
+    def chord_lines():
+        for step in model.stream(seed_notes, max_tokens, do_sample=True, temperature=temperature,
+                                 watermark_proccessor=watermark_processor, chords=True):
+            yield json.dumps({
+                "chord": encoder.decode(step.tokens).tolist(),
+                "num_generated": step.num_generated,
+                "token_seconds": step.token_seconds,
+                "elapsed_seconds": step.elapsed_seconds,
+            }) + "\n"
+
+    return Response(stream_with_context(chord_lines()), mimetype="application/x-ndjson")
+
 @app.route('/detect_watermark', methods=['POST'])
 def detect_watermark():
     if 'music_file' not in request.files:
         return jsonify({'error': 'No file uploaded'}), 400
 
     music_file = request.files['music_file']
-    
-    fpath = "/tmp/temp.wav"
-    if os.path.exists(fpath):
-        os.remove(fpath)
-    
-    with open("/tmp/temp.wav", 'wb') as f:
-        f.write(music_file.read())
-    music_file = "/tmp/temp.wav"
-    
 
     encoder = BachChoralesEncoder()
     
-    # tempo = int(request.args['tempo'])
-    tempo = 220
-    
-    chorale = TetradPlayer().from_wav(music_file, tempo = tempo)
-    print(chorale)
-    
-    watermark_detector = WatermarkDetector(device = 'cpu', tokenizer= encoder)
-    
-    detection_result = watermark_detector.detect(text= torch.as_tensor(chorale.flatten()))
+    # decode the upload stream chunk by chunk and score each chunk of chords as soon as it is decoded
+    watermark_detector = StreamingWatermarkDetector(device = 'cpu', tokenizer= encoder)
+    if music_file.filename.lower().endswith(('.mid', '.midi')):
+        chord_chunks = [TetradPlayer.from_midi(music_file.stream)]
+    else:
+        # recordings can have any tempo and leading silence, so find the beat grid before decoding
+        player = TetradPlayer()
+        try:
+            tempo, offset = player.estimate_wav_beat_grid(music_file.stream)
+        except ValueError:
+            # too short or too quiet to estimate, decode at the default tempo like before
+            tempo, offset = player.tempo, 0
+        chord_chunks = player.iter_wav_chords(music_file.stream, tempo = tempo, offset = offset)
+    for chords in chord_chunks:
+        watermark_detector.update(text= torch.as_tensor(chords.flatten()))
+    
+    detection_result = watermark_detector.score()
     print(detection_result)
     
 
@@ -0,0 +1,103 @@
+"""
+Check the "sdpa" and "chunked" attention backends against the reference "math" backend, then time a training
+step with each.
+
+Every backend loads the same weights (through a state dict saved by the "math" backend, which includes the
+casual_mask buffer) and must match the reference logits, loss and gradients, and its greedy generate and
+generate_batch outputs, with and without the KV cache. Uses randomly initialized models with the same shape as
+the Bach chorales model. Run from the repo root:
+
+    python benchmarks/attention_backends.py
+"""
+import time
+
+import torch
+
+from midigpt import GPT, ModelConfigure
+
+backends = ["math", "sdpa", "chunked"]
+context_lengths = [256, 1024]
+batch_size = 8
+num_steps = 3
+tolerance = 1e-5
+
+
+def make_config(backend: str, context_length: int) -> ModelConfigure:
+    # chunks that don't divide the context length, so the last chunk is partial
+    return ModelConfigure(
+        vocab_size=47,
+        context_length=context_length,
+        embedding_size=64,
+        num_heads=8,
+        num_blocks=12,
+        attn_dropout_prob=0.0,
+        embed_dropout_prob=0.0,
+        attention_backend=backend,
+        attention_chunk_size=48,
+        device="cpu",
+    )
+
+
+def forward_backward(model: GPT, x: torch.Tensor):
+    model.zero_grad(set_to_none=True)
+    logits, loss = model(x, x)
+    loss.backward()
+    return logits.detach(), loss.detach(), [p.grad for p in model.parameters()]
+
+
+def check_parity():
+    torch.manual_seed(42)
+    reference = GPT(make_config("math", 256))
+    state_dict = reference.state_dict()
+    x = torch.randint(0, 47, (4, 256))
+    seeds = [torch.randint(1, 47, (4 * n,)).tolist() for n in (1, 3, 2, 5)]
+    ref_logits, ref_loss, ref_grads = forward_backward(reference.train(), x)
+    reference.eval()
+    ref_generations = {
+        use_cache: (
+            reference.generate(seeds[1], 40, as_list=True, use_cache=use_cache),
+            reference.generate_batch(seeds, 40, as_list=True, use_cache=use_cache),
+        )
+        for use_cache in (True, False)
+    }
+
+    for backend in backends[1:]:
+        model = GPT(make_config(backend, 256))
+        model.load_state_dict(state_dict)
+        logits, loss, grads = forward_backward(model.train(), x)
+        assert torch.allclose(logits, ref_logits, atol=tolerance), f"{backend} logits differ"
+        assert torch.allclose(loss, ref_loss, atol=tolerance), f"{backend} loss differs"
+        for grad, ref_grad in zip(grads, ref_grads):
+            assert torch.allclose(grad, ref_grad, atol=tolerance), f"{backend} gradients differ"
+        model.eval()
+        for use_cache, (ref_generation, ref_batch) in ref_generations.items():
+            assert model.generate(seeds[1], 40, as_list=True, use_cache=use_cache) == ref_generation
+            assert model.generate_batch(seeds, 40, as_list=True, use_cache=use_cache) == ref_batch
+        # and the other way around, a checkpoint without the mask loads into the reference backend
+        GPT(make_config("math", 256)).load_state_dict(model.state_dict())
+        print(f"{backend}: matches math (max logit difference {(logits - ref_logits).abs().max().item():.1e})")
+
+
+def time_training_step(backend: str, context_length: int) -> float:
+    torch.manual_seed(42)
+    model = GPT(make_config(backend, context_length)).train()
+    x = torch.randint(0, 47, (num_steps + 1, batch_size, context_length))
+    forward_backward(model, x[0])
+    start = time.perf_counter()
+    for batch in x[1:]:
+        forward_backward(model, batch)
+    return (time.perf_counter() - start) / num_steps
+
+
+if __name__ == "__main__":
+    check_parity()
+    print(f"training step, batch size {batch_size}")
+    for context_length in context_lengths:
+        timings = {backend: time_training_step(backend, context_length) for backend in backends}
+        print(
+            f"context {context_length:>5}:  "
+            + "  ".join(
+                f"{backend} {seconds * 1000:>7.1f} ms ({timings['math'] / seconds:.1f}x)"
+                for backend, seconds in timings.items()
+            )
+        )
@@ -0,0 +1,67 @@
+"""
+Compare decoding audio to chords one beat at a time against TetradPlayer's batched FFT decoder.
+
+Renders random chords with TetradPlayer, decodes them with a per-beat loop (one rfft and find_peaks call per beat,
+like samples_to_chords did before it was batched) and with samples_to_chords on one and on all cores. Also checks
+that every public decoder returns C-contiguous arrays, which torch.as_tensor needs. Run from the repo root:
+
+    python benchmarks/decode_chords.py
+"""
+import io
+import time
+
+import numpy as np
+import torch
+
+from midigpt import TetradPlayer
+
+num_beats = 2000
+
+player = TetradPlayer()
+rng = np.random.default_rng(42)
+chords = np.sort(rng.integers(48, 84, (num_beats, 4)), axis=1)[:, ::-1]
+samples = player.chords_to_samples(chords, player.tempo, player.sample_rate)
+samples_per_beat = int(player.sample_rate * 60 / player.tempo)
+
+
+def decode_per_beat(samples):
+    decoded = []
+    for beat in range(len(samples) // samples_per_beat):
+        frequencies = player.samples_to_frequencies(
+            samples[beat * samples_per_beat : (beat + 1) * samples_per_beat], player.sample_rate
+        )
+        unique_notes = np.unique(np.round(69 + 12 * np.log2(frequencies / 440)).astype(int))[:4]
+        decoded.append(np.pad(unique_notes, (0, 4 - len(unique_notes)), constant_values=-1)[::-1])
+    return np.array(decoded)
+
+
+def timed(decode):
+    start = time.perf_counter()
+    decoded = decode()
+    return decoded, time.perf_counter() - start
+
+
+per_beat, per_beat_time = timed(lambda: decode_per_beat(samples))
+frames = samples[: num_beats * samples_per_beat].reshape(num_beats, samples_per_beat)
+batched_one_core, one_core_time = timed(lambda: player.frames_to_chords(frames, player.sample_rate, workers=1))
+batched, batched_time = timed(lambda: player.samples_to_chords(samples, player.tempo, player.sample_rate))
+assert np.array_equal(batched, per_beat) and np.array_equal(batched_one_core, per_beat), "batched decoding diverged"
+
+wav = io.BytesIO()
+player.to_wav(chords[:64], wav)
+decoded_arrays = {
+    "samples_to_chords": batched,
+    "iter_wav_chords": next(player.iter_wav_chords(io.BytesIO(wav.getvalue()), beats_per_chunk=16)),
+    "from_wav": player.from_wav(io.BytesIO(wav.getvalue())),
+    "decode_best_tempo": player.decode_best_tempo(samples[: 64 * samples_per_beat], player.sample_rate, [60, 120])[
+        "chords"
+    ],
+}
+for name, decoded in decoded_arrays.items():
+    assert decoded.flags.c_contiguous, f"{name} returned a non-contiguous array"
+    torch.as_tensor(decoded)
+
+print(f"{num_beats} beats of {samples_per_beat} samples")
+print(f"per beat:             {per_beat_time:>6.2f} s")
+print(f"batched, one core:    {one_core_time:>6.2f} s  ({per_beat_time / one_core_time:.2f}x)")
+print(f"batched, all cores:   {batched_time:>6.2f} s  ({per_beat_time / batched_time:.2f}x)")
@@ -0,0 +1,42 @@
+"""
+Compare serving many seeds one at a time with GPT.generate against a single GPT.generate_batch call.
+
+Uses a randomly initialized model with the same shape as the Bach chorales model. Run from the repo root:
+
+    python benchmarks/generate_batch.py
+"""
+import time
+
+import torch
+
+from midigpt import GPT, ModelConfigure
+
+config = ModelConfigure(
+    vocab_size=47,
+    context_length=256,
+    embedding_size=64,
+    num_heads=8,
+    num_blocks=12,
+    device="cpu",
+)
+num_seeds = 32
+num_generated_tokens = 80
+
+torch.manual_seed(42)
+seeds = [torch.randint(1, config.vocab_size, (4 * torch.randint(1, 5, ()).item(),)).tolist() for _ in range(num_seeds)]
+model = GPT(config).eval()
+
+start = time.perf_counter()
+sequential_generations = [model.generate(seed, num_generated_tokens, as_list=True) for seed in seeds]
+sequential_time = time.perf_counter() - start
+
+start = time.perf_counter()
+batched_generations = model.generate_batch(seeds, num_generated_tokens, as_list=True)
+batched_time = time.perf_counter() - start
+
+assert batched_generations == sequential_generations, "batched greedy decoding diverged from generate"
+
+total_tokens = num_seeds * num_generated_tokens
+print(f"{num_seeds} seeds x {num_generated_tokens} generated tokens")
+print(f"sequential: {total_tokens / sequential_time:>8.1f} tokens/sec")
+print(f"batched:    {total_tokens / batched_time:>8.1f} tokens/sec  ({sequential_time / batched_time:.1f}x)")
@@ -0,0 +1,42 @@
+"""
+Compare GPT.generate throughput with and without the key/value cache.
+
+Uses a randomly initialized model with the same shape as the Bach chorales model. Run from the repo root:
+
+    python benchmarks/generate_kv_cache.py
+"""
+import time
+
+import torch
+
+from midigpt import GPT, ModelConfigure
+
+config = ModelConfigure(
+    vocab_size=47,
+    context_length=256,
+    embedding_size=64,
+    num_heads=8,
+    num_blocks=12,
+    device="cpu",
+)
+num_generated_tokens = 240
+
+torch.manual_seed(42)
+seed_notes = torch.randint(1, config.vocab_size, (8,)).tolist()
+model = GPT(config).eval()
+
+
+def tokens_per_second(use_cache):
+    start = time.perf_counter()
+    generation = model.generate(seed_notes, num_generated_tokens, use_cache=use_cache, as_list=True)
+    return generation, num_generated_tokens / (time.perf_counter() - start)
+
+
+uncached_generation, uncached_speed = tokens_per_second(use_cache=False)
+cached_generation, cached_speed = tokens_per_second(use_cache=True)
+
+assert cached_generation == uncached_generation, "cached greedy decoding diverged from the uncached path"
+
+print(f"{num_generated_tokens} generated tokens, {model.num_params} model parameters")
+print(f"uncached: {uncached_speed:>8.1f} tokens/sec")
+print(f"cached:   {cached_speed:>8.1f} tokens/sec  ({cached_speed / uncached_speed:.1f}x)")
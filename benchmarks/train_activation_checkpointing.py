@@ -0,0 +1,108 @@
+"""
+Measure the peak memory and time of a training step with and without activation checkpointing.
+
+Every configuration trains a model of the same shape as the Bach chorales model on random chorale windows of a
+growing context length. Peak memory is the allocator's peak on CUDA, and the growth of the process's peak resident
+set size over the steps on the CPU, so every configuration runs in its own process. Run from the repo root:
+
+    python benchmarks/train_activation_checkpointing.py
+
+Without checkpointing, 1024 token contexts at batch size 8 need tens of GB of activations. On smaller machines
+pass smaller sizes, e.g. --batch-size 2 --context-lengths 128 256 512.
+"""
+import argparse
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+
+from midigpt import GPT, TrainConfigure
+
+context_lengths = [256, 512, 1024]
+batch_size = 8
+num_steps = 3
+device = "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def train_steps(context_length: int, batch_size: int, activation_checkpointing: bool):
+    config = TrainConfigure(
+        vocab_size=60,
+        context_length=context_length,
+        embedding_size=64,
+        num_heads=8,
+        num_blocks=12,
+        batch_size=batch_size,
+        activation_checkpointing=activation_checkpointing,
+    )
+    torch.manual_seed(42)
+    model = GPT(config).to(device)
+    model.train()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=config.learning_rate)
+    x = torch.randint(0, config.vocab_size, (num_steps + 1, batch_size, context_length), device=device)
+
+    def step(batch):
+        _, loss = model(batch, batch)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if device == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+    # the first step allocates the optimizer state, so it is not timed
+    step(x[0])
+    if device == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for batch in x[1:]:
+        step(batch)
+    if device == "cuda":
+        torch.cuda.synchronize()
+        peak_memory = torch.cuda.max_memory_allocated()
+    else:
+        peak_memory = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) * 1024
+    print(f"step: {(time.perf_counter() - start) / num_steps} memory: {peak_memory}")
+
+
+def run(context_length: int, batch_size: int, activation_checkpointing: bool):
+    output = subprocess.run(
+        [
+            sys.executable,
+            __file__,
+            "--worker",
+            str(context_length),
+            str(batch_size),
+            str(int(activation_checkpointing)),
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    seconds = float(output.rsplit("step:", 1)[1].split()[0])
+    memory = int(output.rsplit("memory:", 1)[1].split()[0])
+    return seconds, memory
+
+
+if __name__ == "__main__":
+    if "--worker" in sys.argv:
+        context_length, batch_size, activation_checkpointing = map(int, sys.argv[sys.argv.index("--worker") + 1 :])
+        train_steps(context_length, batch_size, bool(activation_checkpointing))
+        sys.exit()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=batch_size)
+    parser.add_argument("--context-lengths", type=int, nargs="+", default=context_lengths)
+    args = parser.parse_args()
+
+    print(f"batch size {args.batch_size}, {device}")
+    for context_length in args.context_lengths:
+        seconds, memory = run(context_length, args.batch_size, activation_checkpointing=False)
+        checkpointed_seconds, checkpointed_memory = run(context_length, args.batch_size, activation_checkpointing=True)
+        print(
+            f"context {context_length:>5}:  "
+            f"{memory / 2**20:>8.1f} MiB, {seconds * 1000:>7.1f} ms/step  ->  "
+            f"checkpointed {checkpointed_memory / 2**20:>8.1f} MiB, {checkpointed_seconds * 1000:>7.1f} ms/step  "
+            f"({checkpointed_memory / memory:.2f}x memory, {checkpointed_seconds / seconds:.2f}x time)"
+        )
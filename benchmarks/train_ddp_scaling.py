@@ -0,0 +1,72 @@
+"""
+Measure Trainer samples/sec with 1, 2, 4 and 8 data-parallel CPU processes (gloo), launched with torchrun.
+
+Every run trains the same randomly generated chorales for one epoch with a model of the same shape as the
+Bach chorales model, so the global batch and the work per epoch are the same for every process count.
+Run from the repo root on a machine with at least 8 cores:
+
+    python benchmarks/train_ddp_scaling.py
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+
+from midigpt import TrainConfigure, Trainer
+from midigpt.datasets import BachChoraleDataset
+
+process_counts = [1, 2, 4, 8]
+global_batch_size = 96
+num_samples = 96 * 16
+context_length = 256
+
+
+def train():
+    torch.manual_seed(42)
+    chorales = torch.randint(60, 72, (64, 100, 4)).tolist()
+    dataset = BachChoraleDataset(chorales, context_length=context_length)
+    dataset = torch.utils.data.Subset(dataset, range(num_samples))
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    config = TrainConfigure(
+        vocab_size=dataset.dataset.vocab_size,
+        context_length=context_length,
+        embedding_size=64,
+        num_heads=8,
+        num_blocks=12,
+        num_epochs=1,
+        batch_size=global_batch_size // world_size,
+        eval_interval=10**9,
+        device="cpu",
+        checkpoint_path=tempfile.mkdtemp(),
+    )
+    trainer = Trainer(config)
+    start = time.perf_counter()
+    trainer.train(dataset)
+    elapsed = time.perf_counter() - start
+    if trainer.is_main_process:
+        print(f"samples/sec: {num_samples / elapsed:.1f}")
+
+
+if __name__ == "__main__":
+    if "--worker" in sys.argv:
+        train()
+        sys.exit()
+
+    baseline = None
+    print(f"{num_samples} samples, global batch size {global_batch_size}, {os.cpu_count()} cores")
+    for num_processes in process_counts:
+        output = subprocess.run(
+            ["torchrun", "--standalone", f"--nproc_per_node={num_processes}", __file__, "--worker"],
+            env={**os.environ, "OMP_NUM_THREADS": str(max(os.cpu_count() // num_processes, 1))},
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        samples_per_second = float(output.rsplit("samples/sec:", 1)[1].split()[0])
+        baseline = baseline or samples_per_second
+        print(
+            f"{num_processes} processes: {samples_per_second:>8.1f} samples/sec  ({samples_per_second / baseline:.1f}x)"
+        )
@@ -2,27 +2,41 @@ from pathlib import Path
 
 import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 import torch
 import os
 
 from midigpt import GPT, TetradPlayer, WatermarkLogitsProcessor, WatermarkDetector
-from midigpt.datasets import BachChoralesEncoder
+from midigpt.datasets import BachChoralesEncoder, PackedChoraleCorpus
+from midigpt.metrics import read_metrics
 import fire
 
-def load_chorales(filepaths):
-    return [pd.read_csv(filepath).values.tolist() for filepath in filepaths]
 
+def plot_metrics(metrics_path):
+    steps = read_metrics(metrics_path)
+    intervals = read_metrics(metrics_path, "interval")
+    fig, (loss_ax, speed_ax) = plt.subplots(2, 1, sharex=True, figsize=(10, 8))
+    loss_ax.plot(steps["step"], steps["loss"], alpha=0.4, label="batch loss")
+    if len(intervals) > 0:
+        loss_ax.plot(intervals["step"], intervals["loss"], label="average batch loss")
+        loss_ax.plot(intervals["step"], intervals["validation_loss"], label="validation loss")
+    loss_ax.set_ylabel("Log Loss")
+    loss_ax.legend()
+    speed_ax.plot(steps["step"], steps["tokens_per_sec"])
+    speed_ax.set_ylabel("Tokens/sec")
+    speed_ax.set_xlabel("Iteration")
+    fig.savefig("results/training_metrics.png", dpi=200)
 
-def main(generated_tokens = 80, tempo = 220, temperature = 0.5, fpath=""):
+
+def main(generated_tokens = 80, tempo = 220, temperature = 0.5, fpath="", metrics_path=""):
     if not os.path.exists("results/"):
         os.mkdir("results/")
+    if metrics_path != "":
+        plot_metrics(metrics_path)
     if fpath == "":
         return
     assert generated_tokens % 4 == 0
     jsb_chorales_dir = Path("projects/bach-chorales/jsb_chorales/")
-    test_files = sorted(jsb_chorales_dir.glob("test/chorale*.csv"))
-    test_chorales = load_chorales(test_files)
+    test_chorales = PackedChoraleCorpus.from_csv_directory(jsb_chorales_dir / "test")
 
     model = GPT.from_checkpoint("projects/bach-chorales/best_model.ckpt", map_location=torch.device("cpu"))
     encoder = BachChoralesEncoder()
@@ -1,23 +1,21 @@
 from pathlib import Path
 
-import pandas as pd
-
 from midigpt import TrainConfigure, Trainer
-from midigpt.datasets import BachChoraleDataset
-
-
-def load_chorales(file_paths):
-    return [pd.read_csv(p).values.tolist() for p in file_paths]
-
+from midigpt.datasets import BachChoraleDataset, ChoraleTransposition, PackedChoraleCorpus
 
 jsb_chorales_path = Path("jsb_chorales")
-train_chorales = load_chorales(sorted(jsb_chorales_path.glob("train/chorale_*.csv")))
-test_chorales = load_chorales(sorted(jsb_chorales_path.glob("test/chorale_*.csv")))
-train_chorales = train_chorales + test_chorales
-valid_chorales = load_chorales(sorted(jsb_chorales_path.glob("valid/chorale_*.csv")))
+train_chorales = PackedChoraleCorpus.concatenate(
+    [
+        PackedChoraleCorpus.from_csv_directory(jsb_chorales_path / "train"),
+        PackedChoraleCorpus.from_csv_directory(jsb_chorales_path / "test"),
+    ]
+)
+valid_chorales = PackedChoraleCorpus.from_csv_directory(jsb_chorales_path / "valid")
 
 context_length = 256
-train_dataset = BachChoraleDataset(train_chorales, context_length=context_length)
+train_dataset = BachChoraleDataset(
+    train_chorales, context_length=context_length, augmentation=ChoraleTransposition(max_shift=6)
+)
 validation_dataset = BachChoraleDataset(valid_chorales, context_length=context_length)
 
 assert train_dataset.vocab_size == validation_dataset.vocab_size
@@ -1,13 +1,13 @@
 import matplotlib.pyplot as plt
-import numpy as np
 
 from midigpt import GPT
 from midigpt.datasets import TextCharacterTokenizer
+from midigpt.metrics import read_metrics
 
-loss_history = np.genfromtxt("loss_history.txt")
+metrics = read_metrics("metrics.jsonl")
 
 plt.style.use("dark_background")
-plt.plot(loss_history)
+plt.plot(metrics["step"], metrics["loss"])
 plt.ylabel("Log Loss", fontsize=15)
 plt.xlabel("Iteration", fontsize=15)
 plt.savefig("loss_history.png", dpi=200)
@@ -2,9 +2,16 @@ from pathlib import Path
 
 from . import datasets
 from .config import ModelConfigure, TrainConfigure
-from .gpt import GPT
-from .watermarking import WatermarkLogitsProcessor, WatermarkDetector
+from .evaluation import Evaluator
+from .gpt import GPT, GenerationStep
+from .watermarking import (
+    StreamingWatermarkDetector,
+    WatermarkDetector,
+    WatermarkKeyRegistry,
+    WatermarkLogitsProcessor,
+)
 from .player import TetradPlayer
+from .profiling import profile
 from .trainer import Trainer
 
 __version__ = "0.0.1-beta.5"
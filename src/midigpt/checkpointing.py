@@ -0,0 +1,121 @@
+import queue
+import random
+import re
+import threading
+from pathlib import Path
+from typing import List, Optional, Union
+
+import numpy as np
+import torch
+
+from .utils import atomic_save
+
+__all__ = ["CheckpointWriter", "get_rng_states", "list_checkpoints", "set_rng_states"]
+
+# best checkpoints without overwrite_checkpoints are epoch_<epoch>_batch_<batch>.ckpt, rolling resume points are
+# resume_epoch_<epoch>_batch_<batch>.ckpt, and only the latter are pruned
+_NUMBERED_CHECKPOINT = re.compile(r"(?:resume_)?epoch_(\d+)_batch_(\d+)\.ckpt")
+_RESUME_CHECKPOINT = re.compile(r"resume_epoch_(\d+)_batch_(\d+)\.ckpt")
+
+
+def list_checkpoints(directory: Union[str, Path], resume_points_only: bool = False) -> List[Path]:
+    """
+    The numbered checkpoints in a directory, oldest first: best checkpoints saved without overwrite_checkpoints
+    (epoch_<epoch>_batch_<batch>.ckpt) and rolling resume points (resume_epoch_<epoch>_batch_<batch>.ckpt).
+    """
+    pattern = _RESUME_CHECKPOINT if resume_points_only else _NUMBERED_CHECKPOINT
+    numbered = []
+    for path in Path(directory).glob("*epoch_*_batch_*.ckpt"):
+        match = pattern.fullmatch(path.name)
+        if match:
+            numbered.append((int(match.group(1)), int(match.group(2)), path))
+    return [path for *_, path in sorted(numbered)]
+
+
+def _to_cpu(value):
+    # a snapshot that later optimizer steps can't modify, with every tensor copied to the CPU
+    if isinstance(value, torch.Tensor):
+        return value.detach().to("cpu", copy=True)
+    if isinstance(value, dict):
+        return {k: _to_cpu(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_to_cpu(v) for v in value)
+    return value
+
+
+def get_rng_states():
+    """The states of every random number generator training draws from, storable in a weights-only checkpoint."""
+    numpy_state = np.random.get_state()
+    return {
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        "python": random.getstate(),
+        "numpy": (numpy_state[0], torch.from_numpy(numpy_state[1].astype(np.int64)), *numpy_state[2:]),
+    }
+
+
+def set_rng_states(states: dict):
+    torch.set_rng_state(states["torch"])
+    if states["cuda"] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states["cuda"])
+    python_state = states["python"]
+    random.setstate((python_state[0], tuple(python_state[1]), python_state[2]))
+    numpy_state = states["numpy"]
+    np.random.set_state((numpy_state[0], numpy_state[1].numpy().astype(np.uint32), *numpy_state[2:]))
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints from a background thread, so training only waits for the copy of the state to the CPU.
+
+    Every checkpoint is written to a temporary file that is renamed into place, so a crash never leaves a
+    truncated checkpoint behind. With keep_last set, only the keep_last most recent resume points
+    (resume_epoch_<epoch>_batch_<batch>.ckpt) are kept. At most one checkpoint waits to be written at a time.
+    """
+
+    def __init__(self, directory: Union[str, Path], keep_last: Optional[int] = None, asynchronous: bool = True):
+        self.directory = Path(directory)
+        self.keep_last = keep_last
+        self.asynchronous = asynchronous
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = None
+
+    def save(self, checkpoint: dict, file_name: str):
+        self._raise_error()
+        snapshot = _to_cpu(checkpoint)
+        if not self.asynchronous:
+            self._write(snapshot, file_name)
+            return
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="checkpoint-writer", daemon=True)
+            self._thread.start()
+        self._queue.put((snapshot, file_name))
+
+    def wait(self):
+        """Block until every checkpoint passed to save is on disk."""
+        self._queue.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("writing a checkpoint failed") from error
+
+    def _run(self):
+        while True:
+            snapshot, file_name = self._queue.get()
+            try:
+                self._write(snapshot, file_name)
+            except Exception as error:
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _write(self, snapshot: dict, file_name: str):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with atomic_save(self.directory / file_name) as f:
+            torch.save(snapshot, f)
+        if self.keep_last is not None and _RESUME_CHECKPOINT.fullmatch(file_name):
+            for path in list_checkpoints(self.directory, resume_points_only=True)[: -self.keep_last or None]:
+                path.unlink(missing_ok=True)
@@ -1,15 +1,44 @@
 import math
+from typing import Optional, Tuple, Union
 
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.profiler import record_function
+from torch.utils.checkpoint import checkpoint
 
 from .config import ModelConfigure
 
-__all__ = ["CasualMultiHeadAttention", "CasualAttentionBlock", "FeedForward"]
+__all__ = ["CasualMultiHeadAttention", "CasualAttentionBlock", "FeedForward", "KeyValueCache"]
+
+# per-block (keys, values), each of shape (B, num_heads, T, embedding_size // num_heads)
+KeyValueCache = Tuple[torch.Tensor, torch.Tensor]
+
+
+def _allowed_keys(query_positions: torch.Tensor, d_total: int, attention_mask: Optional[torch.Tensor] = None):
+    # True where a query may attend to a key: causal, and not to padding keys (except the query's own position,
+    # so that padding queries still attend to themselves and their unused outputs stay finite)
+    key_positions = torch.arange(d_total, device=query_positions.device)
+    allowed = key_positions <= query_positions[:, None]  # (T_q, T_k)
+    if attention_mask is not None:
+        allowed = allowed & (attention_mask[:, None, None, :] | (key_positions == query_positions[:, None]))
+    return allowed  # (T_q, T_k) or (B, 1, T_q, T_k)
 
 
 class CasualMultiHeadAttention(nn.Module):
+    """
+    Causal multi-head self-attention with one of three interchangeable backends (ModelConfigure.attention_backend):
+
+    - "math": the reference implementation, the full score matrix masked with the casual_mask buffer
+    - "sdpa": torch's fused scaled_dot_product_attention kernels
+    - "chunked": pure torch, attending attention_chunk_size queries at a time and recomputing each chunk's
+      scores during backward, so at most a chunk of the score matrix is alive at once
+
+    "auto" picks "sdpa" when the installed torch has it, otherwise "math" for contexts of at most
+    attention_chunk_size tokens and "chunked" for longer ones. Only "math" keeps the context_length² mask
+    buffer; checkpoints load into every backend with or without it.
+    """
+
     def __init__(self, config: ModelConfigure) -> None:
         super().__init__()
         q_k_v_size = 3 * config.embedding_size
@@ -17,30 +46,117 @@ class CasualMultiHeadAttention(nn.Module):
         self.output_projection = nn.Linear(config.embedding_size, config.embedding_size)
         self.attn_dropout = nn.Dropout(config.attn_dropout_prob)
         self.embed_dropout = nn.Dropout(config.embed_dropout_prob)
-        _tril_reshape = torch.tril(torch.ones(config.context_length, config.context_length)).view(
-            1, 1, config.context_length, config.context_length
-        )
+        self.attention_backend = config.attention_backend
+        if self.attention_backend == "auto" and hasattr(F, "scaled_dot_product_attention"):
+            self.attention_backend = "sdpa"
+        elif self.attention_backend == "auto":
+            # without sdpa, contexts that fit in one chunk are fastest with the reference implementation
+            self.attention_backend = "math" if config.context_length <= config.attention_chunk_size else "chunked"
+        elif self.attention_backend == "sdpa" and not hasattr(F, "scaled_dot_product_attention"):
+            raise ValueError(f"attention_backend='sdpa' needs torch>=2.0, found torch {torch.__version__}")
+        self.attention_chunk_size = config.attention_chunk_size
+        _tril_reshape = None
+        if self.attention_backend == "math":
+            _tril_reshape = torch.tril(torch.ones(config.context_length, config.context_length)).view(
+                1, 1, config.context_length, config.context_length
+            )
         self.register_buffer("casual_mask", _tril_reshape)
         self.num_heads = config.num_heads
         self.embedding_size = config.embedding_size
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # the mask is a constant, so drop it from (or add it to) checkpoints saved with another backend
+        if self.casual_mask is None:
+            state_dict.pop(prefix + "casual_mask", None)
+        else:
+            state_dict.setdefault(prefix + "casual_mask", self.casual_mask)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(
+        self,
+        x: torch.Tensor,
+        past_key_value: Optional[KeyValueCache] = None,
+        use_cache: bool = False,
+        attention_mask: Optional[torch.Tensor] = None,
+    ) -> Union[torch.Tensor, Tuple[torch.Tensor, KeyValueCache]]:
         d_batch, d_context, d_embed = x.size()
         q, k, v = self.attn(x).split(self.embedding_size, dim=2)
         q = q.view(d_batch, d_context, self.num_heads, d_embed // self.num_heads).transpose(1, 2)
         k = k.view(d_batch, d_context, self.num_heads, d_embed // self.num_heads).transpose(1, 2)
         v = v.view(d_batch, d_context, self.num_heads, d_embed // self.num_heads).transpose(1, 2)
 
-        attn = q @ k.transpose(-2, -1) / (k.size(-1) ** 0.5)
-        attn = attn.masked_fill(self.casual_mask[:, :, :d_context, :d_context] == 0, float("-inf"))
-        attn = F.softmax(attn, dim=-1)
-        attn = self.attn_dropout(attn)
-        attended_values = attn @ v
+        # prepend the cached keys/values of the previous positions, if any
+        if past_key_value is not None:
+            past_k, past_v = past_key_value
+            k = torch.cat((past_k, k), dim=-2)
+            v = torch.cat((past_v, v), dim=-2)
+        d_past = k.size(-2) - d_context
+
+        if self.attention_backend == "sdpa":
+            attended_values = self._sdpa_attention(q, k, v, d_past, attention_mask)
+        elif self.attention_backend == "chunked":
+            attended_values = self._chunked_attention(q, k, v, d_past, attention_mask)
+        else:
+            attended_values = self._math_attention(q, k, v, d_past, attention_mask)
         attended_values = attended_values.transpose(1, 2).contiguous().view(*x.size())
 
         output = self.output_projection(attended_values)
         output = self.embed_dropout(output)
-        return output
+        return (output, (k, v)) if use_cache else output
+
+    def _math_attention(self, q, k, v, d_past: int, attention_mask: Optional[torch.Tensor]):
+        d_context = q.size(-2)
+        attn = q @ k.transpose(-2, -1) / (k.size(-1) ** 0.5)
+        attn = attn.masked_fill(
+            self.casual_mask[:, :, d_past : d_past + d_context, : d_past + d_context] == 0, float("-inf")
+        )
+        if attention_mask is not None:
+            # attention_mask is (B, d_past + d_context) and False at padding positions. padding queries
+            # still attend to themselves so that their (unused) outputs stay finite
+            d_total = d_past + d_context
+            is_self = torch.arange(d_total, device=q.device) == torch.arange(d_past, d_total, device=q.device)[:, None]
+            attn = attn.masked_fill(~attention_mask[:, None, None, :] & ~is_self, float("-inf"))
+        attn = F.softmax(attn, dim=-1)
+        attn = self.attn_dropout(attn)
+        return attn @ v
+
+    def _sdpa_attention(self, q, k, v, d_past: int, attention_mask: Optional[torch.Tensor]):
+        d_context, d_total = q.size(-2), k.size(-2)
+        dropout_p = self.attn_dropout.p if self.training else 0.0
+        if attention_mask is None and d_past == 0:
+            return F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p, is_causal=True)
+        if attention_mask is None and d_context == 1:
+            # a single new query attends to every cached position
+            return F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p)
+        # is_causal aligns the mask to the first key, so queries after a cache need an explicit one
+        allowed = _allowed_keys(torch.arange(d_past, d_total, device=q.device), d_total, attention_mask)
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=allowed, dropout_p=dropout_p)
+
+    def _chunked_attention(self, q, k, v, d_past: int, attention_mask: Optional[torch.Tensor]):
+        def attend(q_chunk, k, v, start):
+            # keys after the chunk's last query are masked for every query in the chunk
+            d_keys = d_past + start + q_chunk.size(-2)
+            query_positions = torch.arange(d_past + start, d_keys, device=q.device)
+            k, v = k[:, :, :d_keys], v[:, :, :d_keys]
+            chunk_mask = None if attention_mask is None else attention_mask[:, :d_keys]
+            attn = q_chunk @ k.transpose(-2, -1) / (k.size(-1) ** 0.5)
+            attn = attn.masked_fill(~_allowed_keys(query_positions, d_keys, chunk_mask), float("-inf"))
+            attn = F.softmax(attn, dim=-1)
+            attn = self.attn_dropout(attn)
+            return attn @ v
+
+        if q.size(-2) <= self.attention_chunk_size:
+            # a single chunk has nothing to save by recomputing
+            return attend(q, k, v, 0)
+        recompute = torch.is_grad_enabled() and (q.requires_grad or k.requires_grad or v.requires_grad)
+        chunks = []
+        for start in range(0, q.size(-2), self.attention_chunk_size):
+            q_chunk = q[:, :, start : start + self.attention_chunk_size]
+            if recompute:
+                chunks.append(checkpoint(attend, q_chunk, k, v, start, use_reentrant=False))
+            else:
+                chunks.append(attend(q_chunk, k, v, start))
+        return torch.cat(chunks, dim=-2)
 
 
 class GELU(nn.Module):
@@ -72,7 +188,20 @@ class CasualAttentionBlock(nn.Module):
         self.layer_norm_2 = nn.LayerNorm(config.embedding_size)
         self.ff_net = FeedForward(config)
 
-    def forward(self, x: torch.Tensor):
-        x = x + self.multi_head_self_attention(self.layer_norm_1(x))
-        x = x + self.ff_net(self.layer_norm_2(x))
-        return x
+    def forward(
+        self,
+        x: torch.Tensor,
+        past_key_value: Optional[KeyValueCache] = None,
+        use_cache: bool = False,
+        attention_mask: Optional[torch.Tensor] = None,
+    ):
+        with record_function("attention"):
+            attended = self.multi_head_self_attention(
+                self.layer_norm_1(x), past_key_value=past_key_value, use_cache=use_cache, attention_mask=attention_mask
+            )
+        if use_cache:
+            attended, present_key_value = attended
+        x = x + attended
+        with record_function("feed_forward"):
+            x = x + self.ff_net(self.layer_norm_2(x))
+        return (x, present_key_value) if use_cache else x
@@ -1,7 +1,7 @@
 from pathlib import Path
-from typing import Optional, Union
+from typing import Literal, Optional, Union
 
-from pydantic import BaseModel, root_validator
+from pydantic import BaseModel, root_validator, validator
 
 __all__ = ["ModelConfigure", "TrainConfigure"]
 
@@ -14,6 +14,8 @@ class ModelConfigure(BaseModel):
     num_blocks: int = 4
     attn_dropout_prob: float = 0.1
     embed_dropout_prob: float = 0.1
+    attention_backend: Literal["auto", "math", "sdpa", "chunked"] = "auto"
+    attention_chunk_size: int = 128
     device: str = "auto"
 
     @root_validator
@@ -24,16 +26,53 @@ class ModelConfigure(BaseModel):
             raise ValueError(f"{embedding_size=} is not divisible by {num_heads=}")
         return values
 
+    @validator("attention_chunk_size")
+    def check_attention_chunk_size(cls, value):
+        if value < 1:
+            raise ValueError(f"attention_chunk_size={value} must be at least 1")
+        return value
+
 
 class TrainConfigure(ModelConfigure):
     batch_size: int = 32
     learning_rate: float = 5e-4
     batches_per_eval: int = 100
     eval_interval: int = 500
+    eval_batch_size: Optional[int] = None
+    eval_seed: int = 0
     num_epochs: int = 3
     checkpoint_path: Union[str, Path] = Path("checkpoints")
     save_all_checkpoints: bool = False
     overwrite_checkpoints: bool = True
+    precision: Literal["fp32", "bf16"] = "fp32"
+    gradient_accumulation_steps: int = 1
+    max_grad_norm: Optional[float] = None
+    distributed_backend: str = "gloo"
+    data_seed: int = 0
+    async_checkpointing: bool = True
+    keep_last_checkpoints: Optional[int] = None
+    progress_metrics: bool = True
+    activation_checkpointing: bool = False
+    profile: bool = False
+    profile_wait: int = 5
+    profile_warmup: int = 2
+    profile_active: int = 5
+
+    @validator("gradient_accumulation_steps")
+    def check_gradient_accumulation_steps(cls, value, values):
+        if value < 1:
+            raise ValueError(f"gradient_accumulation_steps={value} must be at least 1")
+        # checkpoints are written at eval intervals and can't hold a half-accumulated gradient
+        eval_interval = values.get("eval_interval")
+        if eval_interval is not None and eval_interval % value != 0:
+            raise ValueError(f"eval_interval={eval_interval} is not a multiple of gradient_accumulation_steps={value}")
+        return value
+
+    @validator("keep_last_checkpoints")
+    def check_keep_last_checkpoints(cls, value):
+        if value is not None and value < 1:
+            raise ValueError(f"keep_last_checkpoints={value} must be at least 1")
+        return value
 
     @property
     def model_config(self):
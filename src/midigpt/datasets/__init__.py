@@ -1,6 +1,6 @@
 from typing import Type, Union
 
-from .tetrad import BachChoraleDataset, BachChoralesEncoder
+from .tetrad import BachChoraleDataset, BachChoralesEncoder, ChoraleTransposition, PackedChoraleCorpus
 from .text_character import TextCharacterDataset, TextCharacterTokenizer
 
 DatasetType = Union[Type[BachChoraleDataset], Type[TextCharacterDataset]]
@@ -1,9 +1,16 @@
-from itertools import chain
+from pathlib import Path
+from typing import List, Optional, Sequence, Union
 
+import numpy as np
 import torch
 from torch.utils.data import Dataset
 
-__all__ = ["BachChoraleDataset", "BachChoralesEncoder"]
+from ..utils import atomic_save
+
+__all__ = ["BachChoraleDataset", "BachChoralesEncoder", "ChoraleTransposition", "PackedChoraleCorpus"]
+
+_BOUNDARY_MODES = ("pad", "within", "cross")
+_OUT_OF_RANGE_MODES = ("clip", "reject")
 
 
 class BachChoralesEncoder:
@@ -19,7 +26,6 @@ class BachChoralesEncoder:
     def encode(self, chorale):
         chorale = torch.as_tensor(chorale)
         chorale[chorale > 0] = chorale[chorale > 0] - self.shift
-        print(chorale)
         return chorale
 
     def decode(self, chorale):
@@ -28,30 +34,207 @@ class BachChoralesEncoder:
         return chorale
 
 
+class PackedChoraleCorpus:
+    """
+    Chorales packed into one array of MIDI note tokens, four per chord, with tokens[offsets[i] : offsets[i + 1]]
+    the tokens of chorale i.
+    """
+
+    n_voices = 4
+
+    def __init__(
+        self,
+        tokens: np.ndarray,
+        offsets: np.ndarray,
+        names: Optional[Sequence[str]] = None,
+        source_mtimes: Optional[Sequence[int]] = None,
+    ):
+        self.tokens = np.asarray(tokens)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.names = np.asarray([] if names is None else names, dtype=str)
+        self.source_mtimes = np.asarray([] if source_mtimes is None else source_mtimes, dtype=np.int64)
+        assert self.offsets[0] == 0 and self.offsets[-1] == len(self.tokens), "offsets must span the tokens"
+        assert (np.diff(self.offsets) % self.n_voices == 0).all(), "chorales must be made of 4 note chords"
+
+    @classmethod
+    def from_chorales(cls, chorales, names: Optional[Sequence[str]] = None, source_mtimes=None):
+        arrays = [np.asarray(chorale, dtype=np.uint8).reshape(-1) for chorale in chorales]
+        assert all(np.ndim(chorale) == 2 and np.shape(chorale)[1] == cls.n_voices for chorale in chorales), (
+            "chorales must be a list of lists of 4 integers"
+        )
+        offsets = np.concatenate(([0], np.cumsum([len(a) for a in arrays])))
+        tokens = np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.uint8)
+        return cls(tokens, offsets, names=names, source_mtimes=source_mtimes)
+
+    @classmethod
+    def from_csv_files(cls, file_paths: Sequence[Union[str, Path]]):
+        """Parse chorale CSVs with a header row and one chord per row."""
+        file_paths = [Path(p) for p in file_paths]
+        chorales = [np.loadtxt(p, delimiter=",", skiprows=1, dtype=np.int64, ndmin=2) for p in file_paths]
+        return cls.from_chorales(
+            chorales, names=[p.name for p in file_paths], source_mtimes=[p.stat().st_mtime_ns for p in file_paths]
+        )
+
+    @classmethod
+    def from_csv_directory(
+        cls,
+        directory: Union[str, Path],
+        pattern: str = "chorale_*.csv",
+        cache_path: Optional[Union[str, Path]] = None,
+    ):
+        """
+        Load the chorale CSVs of a directory, through a packed corpus (by default "<directory>.packed.npz")
+        that is built on first use and rebuilt whenever a CSV is added, removed or modified.
+        """
+        directory = Path(directory)
+        cache_path = directory.parent / f"{directory.name}.packed.npz" if cache_path is None else Path(cache_path)
+        file_paths = sorted(directory.glob(pattern))
+        if cache_path.exists():
+            corpus = cls.load(cache_path)
+            if corpus.names.tolist() == [p.name for p in file_paths] and corpus.source_mtimes.tolist() == [
+                p.stat().st_mtime_ns for p in file_paths
+            ]:
+                return corpus
+        corpus = cls.from_csv_files(file_paths)
+        corpus.save(cache_path)
+        return corpus
+
+    @classmethod
+    def concatenate(cls, corpora: Sequence["PackedChoraleCorpus"]):
+        tokens = np.concatenate([corpus.tokens for corpus in corpora])
+        lengths = np.concatenate([np.diff(corpus.offsets) for corpus in corpora])
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        names = np.concatenate([corpus.names for corpus in corpora])
+        source_mtimes = np.concatenate([corpus.source_mtimes for corpus in corpora])
+        return cls(tokens, offsets, names=names, source_mtimes=source_mtimes)
+
+    def save(self, path: Union[str, Path]):
+        with atomic_save(path) as f:
+            np.savez(f, tokens=self.tokens, offsets=self.offsets, names=self.names, source_mtimes=self.source_mtimes)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]):
+        with np.load(path) as packed:
+            return cls(packed["tokens"], packed["offsets"], packed["names"], packed["source_mtimes"])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.tokens[self.offsets[idx] : self.offsets[idx + 1]].reshape(-1, self.n_voices)
+
+    def to_list(self) -> List[List[List[int]]]:
+        return [self[i].tolist() for i in range(len(self))]
+
+
+class ChoraleTransposition:
+    """
+    Transpose every window of a batch of encoded chorales by its own random number of semitones, on the
+    whole batch at once. Rests (0) and ignored targets (-1) are kept.
+
+    A shift that would take a window outside the C1-A5 range of the encoder is clipped to the largest
+    shift that fits with out_of_range="clip", or replaced by no shift with out_of_range="reject".
+    """
+
+    def __init__(self, max_shift=6, out_of_range="clip", c1_encoded=1, generator: Optional[torch.Generator] = None):
+        if out_of_range not in _OUT_OF_RANGE_MODES:
+            raise ValueError(f"{out_of_range=} must be one of {_OUT_OF_RANGE_MODES}")
+        encoder = BachChoralesEncoder(c1_encoded=c1_encoded)
+        self.min_note = encoder._C1 - encoder.shift
+        self.max_note = encoder._A5 - encoder.shift
+        self.max_shift = max_shift
+        self.out_of_range = out_of_range
+        self.generator = generator
+
+    def __call__(self, x: torch.Tensor, y: torch.Tensor):
+        tokens = torch.cat((x, y), dim=1)
+        is_note = tokens > 0
+        lowest = torch.where(is_note, tokens, self.max_note).amin(dim=1, keepdim=True)
+        highest = torch.where(is_note, tokens, self.min_note).amax(dim=1, keepdim=True)
+        shifts = torch.randint(
+            -self.max_shift, self.max_shift + 1, (len(x), 1), generator=self.generator, device=x.device
+        )
+        min_shift, max_shift = self.min_note - lowest, self.max_note - highest
+        if self.out_of_range == "clip":
+            shifts = torch.minimum(torch.maximum(shifts, min_shift), max_shift)
+        else:
+            shifts = torch.where((shifts >= min_shift) & (shifts <= max_shift), shifts, 0)
+        return torch.where(x > 0, x + shifts, x), torch.where(y > 0, y + shifts, y)
+
+
+def _concatenated_ranges(begins: torch.Tensor, ends: torch.Tensor):
+    # the concatenation of range(begin, end) for every (begin, end) pair, without a Python loop
+    counts = (ends - begins).clamp(min=0)
+    first = torch.repeat_interleave(begins - (torch.cumsum(counts, 0) - counts), counts)
+    return torch.arange(int(counts.sum())) + first
+
+
 class BachChoraleDataset(Dataset):
     _C1 = 36
     _A5 = 81
 
-    def __init__(self, chorales, context_length, c1_encoded=1):
-        assert len(chorales[0][0]) == 4, "chorales must be a list of lists of 4 integers"
+    def __init__(self, chorales, context_length, c1_encoded=1, boundaries="pad", augmentation=None):
+        """
+        :param chorales: A PackedChoraleCorpus, or a list of chorales that are lists of 4 note chords.
+        :param boundaries: How windows treat the end of a chorale. With "pad", windows start anywhere in a
+            chorale and continue past its end with rests whose targets are ignored by the loss. With "within",
+            only windows that fit entirely in one chorale are used, and with "cross" the chorales are one
+            stream and windows can span two of them.
+        :param augmentation: A function of a batch of (x, y) windows applied to every batch, e.g. a
+            ChoraleTransposition for the training set.
+        """
         assert context_length % 4 == 0, "context_length must be a multiple of 4"
+        if boundaries not in _BOUNDARY_MODES:
+            raise ValueError(f"{boundaries=} must be one of {_BOUNDARY_MODES}")
+        if not isinstance(chorales, PackedChoraleCorpus):
+            chorales = PackedChoraleCorpus.from_chorales(chorales)
         self.encoder = BachChoralesEncoder(c1_encoded=c1_encoded)
-        corpus = torch.tensor(list(chain.from_iterable(chain.from_iterable(chorales))), dtype=torch.long)
-        corpus = self.encoder.encode(corpus)
-        self.corpus = corpus.tolist()
+        tokens = self.encoder.encode(torch.from_numpy(chorales.tokens.astype(np.int64)))
         self.shift = self._C1 - c1_encoded
         self.min_note = self._C1 - self.shift
         self.max_note = self._A5 - self.shift
         self.vocab = [0] + (torch.arange(self._C1, self._A5 + 1) - self.shift).tolist()
         self.vocab_size = len(self.vocab)
         self.context_length = context_length
-        assert min(set(self.corpus) - {0}) >= self.min_note and max(self.corpus) <= self.max_note, "invalid note range"
+        self.boundaries = boundaries
+        self.augmentation = augmentation
+        notes = tokens[tokens > 0]
+        assert notes.min() >= self.min_note and notes.max() <= self.max_note, "invalid note range"
+
+        offsets = torch.from_numpy(chorales.offsets)
+        begins, ends = offsets[:-1], offsets[1:]
+        if boundaries == "pad":
+            # every chorale is followed by context_length padding tokens, rests as inputs and -1 as targets
+            chorale_index = torch.repeat_interleave(torch.arange(len(chorales)), ends - begins)
+            positions = torch.arange(len(tokens)) + chorale_index * context_length
+            self.corpus = torch.zeros(len(tokens) + len(chorales) * context_length, dtype=torch.long)
+            targets = torch.full_like(self.corpus, -1)
+            self.corpus[positions] = targets[positions] = tokens
+            # windows start at any token of a chorale that is followed by at least one target
+            padded_begins = begins + torch.arange(len(chorales)) * context_length
+            self.starts = _concatenated_ranges(padded_begins, padded_begins + (ends - begins) - 1)
+        else:
+            self.corpus = targets = tokens
+            if boundaries == "within":
+                self.starts = _concatenated_ranges(begins, ends - context_length)
+            else:
+                self.starts = torch.arange(max(len(tokens) - context_length, 0))
+        # all (context_length + 1)-token windows, as strided views of the corpus and targets
+        self.windows = self.corpus.unfold(0, context_length + 1, 1)
+        self.target_windows = targets.unfold(0, context_length + 1, 1)
 
     def __len__(self):
-        return len(self.corpus) - self.context_length
+        return len(self.starts)
 
     def __getitem__(self, idx):
-        context = self.corpus[idx : idx + self.context_length + 1]
-        x = torch.tensor(context[:-1], dtype=torch.long)
-        y = torch.tensor(context[1:], dtype=torch.long)
+        start = self.starts[idx]
+        x, y = self.windows[start, :-1], self.target_windows[start, 1:]
+        if self.augmentation is not None:
+            x, y = (t.squeeze(0) for t in self.augmentation(x.unsqueeze(0), y.unsqueeze(0)))
         return x, y
+
+    def get_batch(self, indices):
+        """Gather the (x, y) windows of a whole batch of indices with a single indexing operation."""
+        starts = self.starts[torch.as_tensor(indices)]
+        x, y = self.windows[starts, :-1], self.target_windows[starts, 1:]
+        return (x, y) if self.augmentation is None else self.augmentation(x, y)
@@ -1,11 +1,25 @@
+import json
+import os
+import struct
 from pathlib import Path
-from typing import List, Union
+from typing import List, Optional, Union
 
+import numpy as np
 import torch
 from torch.utils.data import Dataset
 
+from ..utils import atomic_save
+
 __all__ = ["TextCharacterDataset", "TextCharacterTokenizer"]
 
+# token cache layout: magic | header length (uint32) | number of tokens (uint64) | JSON header | zero padding
+# to the alignment | tokens, all little-endian
+_TOKEN_CACHE_MAGIC = b"MGPTTOK1"
+_TOKEN_CACHE_ALIGNMENT = 64
+
+# characters read and tokenized at a time while building a token cache
+_TOKEN_CACHE_CHUNK_SIZE = 1 << 24
+
 
 class TextCharacterTokenizer:
     def __init__(self, vocabulary: List[str]):
@@ -28,30 +42,179 @@ class TextCharacterTokenizer:
     def encode(self, text: str):
         return [self.str_to_int[s] for s in text]
 
+    def encode_array(self, text: str, dtype=np.int64):
+        return np.fromiter(map(self.str_to_int.__getitem__, text), dtype=dtype, count=len(text))
+
     def decode(self, tokens: List[int]):
         return "".join([self.int_to_str[t] for t in tokens])
 
 
+def _token_dtype(vocab_size: int):
+    if vocab_size <= 1 << 8:
+        return np.dtype(np.uint8)
+    if vocab_size <= 1 << 16:
+        return np.dtype(np.uint16)
+    raise ValueError(f"{vocab_size=} is too large for a token cache")
+
+
+def _iter_text_chunks(file_path: Union[str, Path]):
+    with open(file_path, "r") as f:
+        while chunk := f.read(_TOKEN_CACHE_CHUNK_SIZE):
+            yield chunk
+
+
+def _token_cache_header_bytes(header: dict):
+    encoded = json.dumps({k: v for k, v in header.items() if k not in ("num_tokens", "offset")}).encode("utf-8")
+    prefix = _TOKEN_CACHE_MAGIC + struct.pack("<IQ", len(encoded), header["num_tokens"]) + encoded
+    return prefix + bytes(-len(prefix) % _TOKEN_CACHE_ALIGNMENT)
+
+
+def _read_token_cache_header(cache_path: Union[str, Path]):
+    with open(cache_path, "rb") as f:
+        if f.read(len(_TOKEN_CACHE_MAGIC)) != _TOKEN_CACHE_MAGIC:
+            raise ValueError(f"{cache_path} is not a token cache")
+        header_length, num_tokens = struct.unpack("<IQ", f.read(12))
+        header = json.loads(f.read(header_length).decode("utf-8"))
+    header["num_tokens"] = num_tokens
+    header["offset"] = len(_token_cache_header_bytes(header))
+    return header
+
+
 class TextCharacterDataset(Dataset):
-    def __init__(self, text_corpus: str, vocabulary: List[str], context_length: int):
-        self.text_corpus = text_corpus
+    def __init__(
+        self,
+        text_corpus: Optional[str],
+        vocabulary: List[str],
+        context_length: int,
+        tokens: Optional[np.ndarray] = None,
+    ):
+        """
+        :param text_corpus: The text to train on, tokenized once here. Ignored if tokens is given.
+        :param tokens: An already tokenized corpus, e.g. the memmap of a token cache.
+        """
         self.vocabulary = vocabulary
         self.vocab_size = len(self.vocabulary)
         self.context_length = context_length
         self.tokenizer = TextCharacterTokenizer(vocabulary)
+        if tokens is None:
+            tokens = self.tokenizer.encode_array(text_corpus, _token_dtype(self.vocab_size))
+        self.tokens = tokens
+        self.token_cache_path = None
 
     @classmethod
-    def from_file(cls, file_path: Union[str, Path], vocabulary: List[str], context_length: int):
-        with open(file_path, "r") as f:
-            text_corpus = f.read()
-        return cls(text_corpus, vocabulary, context_length)
+    def from_file(
+        cls,
+        file_path: Union[str, Path],
+        vocabulary: List[str],
+        context_length: int,
+        cache_path: Optional[Union[str, Path]] = None,
+        use_cache: bool = True,
+    ):
+        """
+        Load a text file, by default through a token cache next to it (file_path + ".tokens") that is
+        built on first use and rebuilt whenever the file or the vocabulary changes.
+        """
+        if not use_cache:
+            with open(file_path, "r") as f:
+                text_corpus = f.read()
+            return cls(text_corpus, vocabulary, context_length)
+        cache_path = Path(f"{file_path}.tokens") if cache_path is None else Path(cache_path)
+        if not cls._is_token_cache_fresh(cache_path, file_path, vocabulary):
+            cls.build_token_cache(file_path, cache_path, vocabulary=vocabulary)
+        return cls.from_token_cache(cache_path, context_length)
+
+    @staticmethod
+    def _source_stat(file_path: Union[str, Path]):
+        stat = os.stat(file_path)
+        return dict(source_size=stat.st_size, source_mtime_ns=stat.st_mtime_ns)
+
+    @classmethod
+    def _is_token_cache_fresh(cls, cache_path: Path, file_path: Union[str, Path], vocabulary: Optional[List[str]]):
+        if not cache_path.exists():
+            return False
+        try:
+            header = _read_token_cache_header(cache_path)
+        except ValueError:
+            return False
+        source_stat = cls._source_stat(file_path)
+        cache_size = header["offset"] + header["num_tokens"] * np.dtype(header["dtype"]).itemsize
+        return (
+            all(header.get(key) == value for key, value in source_stat.items())
+            and (vocabulary is None or header["vocabulary"] == list(vocabulary))
+            and os.path.getsize(cache_path) == cache_size
+        )
+
+    @classmethod
+    def build_token_cache(
+        cls,
+        file_path: Union[str, Path],
+        cache_path: Union[str, Path],
+        vocabulary: Optional[List[str]] = None,
+    ):
+        """
+        Tokenize a text file once into a compact binary token cache, reading it in chunks so corpora larger
+        than memory work. The vocabulary defaults to the sorted characters of the file.
+
+        :return: The path to the token cache.
+        """
+        if vocabulary is None:
+            characters = set()
+            for chunk in _iter_text_chunks(file_path):
+                characters.update(chunk)
+            vocabulary = sorted(characters)
+        tokenizer = TextCharacterTokenizer(list(vocabulary))
+        dtype = _token_dtype(tokenizer.vocab_size)
+
+        cache_path = Path(cache_path)
+        header = dict(vocabulary=tokenizer.vocabulary, dtype=dtype.name, num_tokens=0, **cls._source_stat(file_path))
+        # replaced atomically, so concurrent processes never see a partially written cache
+        with atomic_save(cache_path) as f:
+            # the token count is only known at the end, so it is patched into the header afterwards
+            f.write(_token_cache_header_bytes(header))
+            for chunk in _iter_text_chunks(file_path):
+                tokens = tokenizer.encode_array(chunk, dtype)
+                header["num_tokens"] += len(tokens)
+                f.write(tokens.tobytes())
+            f.seek(0)
+            f.write(_token_cache_header_bytes(header))
+        return cache_path
+
+    @classmethod
+    def from_token_cache(cls, cache_path: Union[str, Path], context_length: int):
+        """
+        Serve a dataset from a token cache written by build_token_cache. The tokens are memory-mapped, so
+        loading is instant, processes training on the same corpus share the OS page cache and the corpus
+        doesn't have to fit in memory.
+        """
+        header = _read_token_cache_header(cache_path)
+        tokens = np.memmap(
+            cache_path, dtype=header["dtype"], mode="r", offset=header["offset"], shape=(header["num_tokens"],)
+        )
+        dataset = cls(None, header["vocabulary"], context_length, tokens=tokens)
+        dataset.token_cache_path = Path(cache_path)
+        return dataset
+
+    def __getstate__(self):
+        # a memmap would be pickled (e.g. to DataLoader workers) as a full in-memory copy, so reopen it instead
+        state = self.__dict__.copy()
+        if self.token_cache_path is not None:
+            state["tokens"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.tokens is None:
+            self.tokens = type(self).from_token_cache(self.token_cache_path, self.context_length).tokens
 
     def __len__(self):
-        return len(self.text_corpus) - self.context_length
+        return len(self.tokens) - self.context_length
 
     def __getitem__(self, idx):
-        context = self.text_corpus[idx : idx + self.context_length + 1]
-        context_encoded = self.tokenizer.encode(context)
-        x = torch.tensor(context_encoded[:-1], dtype=torch.long)
-        y = torch.tensor(context_encoded[1:], dtype=torch.long)
-        return x, y
+        window = torch.from_numpy(self.tokens[idx : idx + self.context_length + 1].astype(np.int64))
+        return window[:-1], window[1:]
+
+    def get_batch(self, indices):
+        """Gather the (x, y) windows of a whole batch of indices with a single indexing operation."""
+        windows = np.asarray(indices)[:, None] + np.arange(self.context_length + 1)
+        windows = torch.from_numpy(self.tokens[windows].astype(np.int64))
+        return windows[:, :-1], windows[:, 1:]
@@ -0,0 +1,72 @@
+import contextlib
+from typing import Callable, ContextManager, Optional
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import Subset
+from torch.utils.data.dataloader import default_collate
+
+from . import utils
+from .datasets import DatasetType
+
+__all__ = ["Evaluator"]
+
+
+def _gather_batch(dataset: DatasetType, indices: torch.Tensor):
+    if isinstance(dataset, Subset):
+        indices = torch.as_tensor(dataset.indices)[indices]
+        dataset = dataset.dataset
+    if hasattr(dataset, "get_batch"):
+        return dataset.get_batch(indices)
+    return default_collate([dataset[i] for i in indices.tolist()])
+
+
+class Evaluator:
+    """
+    Validation loss on a fixed subset of a dataset, drawn once with a seeded generator so that every evaluation
+    (and every run with the same seed) scores the same samples. The subset's batches are gathered once and kept
+    on the device, and the loss is the exact mean over all of their targets.
+
+    In a torch.distributed process group every process evaluates its own shard of the subset.
+    """
+
+    def __init__(
+        self,
+        dataset: DatasetType,
+        num_samples: int,
+        batch_size: int,
+        device: str = "cpu",
+        seed: int = 0,
+        autocast: Optional[Callable[[], ContextManager]] = None,
+    ):
+        generator = torch.Generator().manual_seed(seed)
+        indices = torch.randperm(len(dataset), generator=generator)[:num_samples]
+        indices = indices[utils.get_rank() :: utils.get_world_size()]
+        self.num_samples = len(indices)
+        self.autocast = contextlib.nullcontext if autocast is None else autocast
+        self.batches = []
+        for batch_indices in indices.split(batch_size):
+            x, y = _gather_batch(dataset, batch_indices)
+            self.batches.append((x.to(device), y.to(device)))
+
+    @torch.no_grad()
+    def evaluate(self, model: torch.nn.Module) -> float:
+        was_training = model.training
+        model.eval()
+        try:
+            total_loss = torch.zeros((), dtype=torch.float64, device=self.batches[0][0].device)
+            num_targets = torch.zeros_like(total_loss)
+            for x, y in self.batches:
+                with self.autocast():
+                    _, loss = model(x, y)
+                # the loss ignores -1 targets, so weight every batch by its number of scored targets
+                batch_targets = (y != -1).sum()
+                total_loss += loss.double() * batch_targets
+                num_targets += batch_targets
+        finally:
+            model.train(was_training)
+        if dist.is_initialized():
+            totals = torch.stack((total_loss, num_targets)).cpu()
+            dist.all_reduce(totals)
+            total_loss, num_targets = totals
+        return (total_loss / num_targets).item()
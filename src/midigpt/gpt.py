@@ -1,15 +1,37 @@
+import time
+from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Optional, Union
+from typing import Iterator, List, Optional, Tuple, Union
 
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.profiler import record_function
+from torch.utils.checkpoint import checkpoint
 
-from . import utils
-from .components import CasualAttentionBlock
+from . import profiling, utils
+from .components import CasualAttentionBlock, KeyValueCache
 from .config import ModelConfigure, TrainConfigure
 
-__all__ = ["GPT"]
+__all__ = ["GPT", "GenerationStep"]
+
+
+@dataclass
+class GenerationStep:
+    """A streamed piece of a generation: the newly sampled token, or a completed tetrad chord."""
+
+    tokens: List[int]
+    num_generated: int  # total number of tokens generated so far
+    token_seconds: List[float]  # time spent sampling each token since the previous step
+    elapsed_seconds: float  # time since the stream started
+
+
+def _per_sequence(value, num_seqs: int, name: str) -> list:
+    if isinstance(value, (list, tuple)):
+        if len(value) != num_seqs:
+            raise ValueError(f"got {len(value)} values for {name} but {num_seqs} seeds")
+        return list(value)
+    return [value] * num_seqs
 
 
 class GPT(nn.Module):
@@ -24,6 +46,8 @@ class GPT(nn.Module):
         self.apply(self._init_weights)
         self.context_length = config.context_length
         self.device = "cpu"
+        # recompute every block's activations during backward instead of keeping them from the forward pass
+        self.activation_checkpointing = isinstance(config, TrainConfigure) and config.activation_checkpointing
 
     def _init_weights(self, module):
         if isinstance(module, (nn.Linear, nn.Embedding)):
@@ -37,6 +61,8 @@ class GPT(nn.Module):
 
     @classmethod
     def from_checkpoint(cls, path: Union[str, Path], **kwargs):
+        # the model config and state dict only hold plain types and tensors
+        kwargs.setdefault("weights_only", True)
         checkpoint = torch.load(path, **kwargs)
         config = checkpoint["model_config"]
         model = cls(ModelConfigure(**config))
@@ -45,20 +71,113 @@ class GPT(nn.Module):
         return model
 
     def forward(self, x: torch.LongTensor, targets: Optional[torch.LongTensor] = None):
-        token_embedding = self.token_embedding_table(x)  # (B, T, C)
-        position_embedding = self.position_embedding_table(torch.arange(x.shape[1], device=self.device))  # (T, C)
-        x = token_embedding + position_embedding  # (B, T, C)
-        x = self.blocks(x)  # (B, T, C)
+        with record_function("embedding"):
+            token_embedding = self.token_embedding_table(x)  # (B, T, C)
+            position_embedding = self.position_embedding_table(torch.arange(x.shape[1], device=self.device))  # (T, C)
+            x = token_embedding + position_embedding  # (B, T, C)
+        checkpoint_blocks = self.activation_checkpointing and self.training and torch.is_grad_enabled()
+        for block_num, block in enumerate(self.blocks):
+            with record_function(f"CasualAttentionBlock_{block_num}"):
+                x = checkpoint(block, x, use_reentrant=False) if checkpoint_blocks else block(x)  # (B, T, C)
         x = self.final_layer_norm(x)  # (B, T, C)
-        logits = self.lm_head(x)  # (B, T, vocab_size)
+        with record_function("lm_head"):
+            logits = self.lm_head(x)  # (B, T, vocab_size)
         loss = (
             None
             if targets is None
-            else F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1)
+            else F.cross_entropy(logits.view(-1, logits.size(-1)), targets.reshape(-1), ignore_index=-1)
         )
         return logits, loss
 
+    def forward_with_cache(
+        self,
+        x: torch.LongTensor,
+        past_key_values: Optional[List[KeyValueCache]] = None,
+        position_ids: Optional[torch.LongTensor] = None,
+        attention_mask: Optional[torch.BoolTensor] = None,
+    ) -> Tuple[torch.Tensor, List[KeyValueCache]]:
+        """Forward pass over new tokens only, attending to the cached keys/values of the earlier positions.
+
+        Returns the logits of the new tokens and the updated per-block key/value cache. The total number of
+        cached plus new positions must not exceed context_length. For padded batches, position_ids gives the
+        (B, T) positions of the new tokens and attention_mask is a (B, cached + T) mask that is False at padding.
+        """
+        past_length = 0 if past_key_values is None else past_key_values[0][0].size(-2)
+        if past_length + x.shape[1] > self.context_length:
+            raise ValueError(f"{past_length=} + {x.shape[1]=} exceeds {self.context_length=}")
+        if position_ids is None:
+            position_ids = torch.arange(past_length, past_length + x.shape[1], device=x.device)
+        with record_function("embedding"):
+            token_embedding = self.token_embedding_table(x)  # (B, T, C)
+            position_embedding = self.position_embedding_table(position_ids)  # (T, C) or (B, T, C)
+            x = token_embedding + position_embedding  # (B, T, C)
+        present_key_values = []
+        for block_num, block in enumerate(self.blocks):
+            past_key_value = None if past_key_values is None else past_key_values[block_num]
+            with record_function(f"CasualAttentionBlock_{block_num}"):
+                x, present_key_value = block(
+                    x, past_key_value=past_key_value, use_cache=True, attention_mask=attention_mask
+                )
+            present_key_values.append(present_key_value)
+        x = self.final_layer_norm(x)  # (B, T, C)
+        with record_function("lm_head"):
+            logits = self.lm_head(x)  # (B, T, vocab_size)
+        return logits, present_key_values
+
     @torch.no_grad()
+    def _generate_tokens(
+        self,
+        idx: torch.LongTensor,
+        num_generated_tokens: int,
+        temperature: float = 1.0,
+        do_sample: bool = False,
+        top_k: Optional[int] = None,
+        watermark_proccessor=None,
+        use_cache: bool = True,
+    ) -> Iterator[torch.LongTensor]:
+        """Yield the running (1, T) sequence after each sampled token."""
+        changed_training_mode = False
+        if self.training:
+            self.eval()
+            changed_training_mode = True
+        past_key_values = None
+        try:
+            for _ in range(num_generated_tokens):
+                if use_cache and idx.size(1) <= self.context_length:
+                    # prefill the cache with the seed on the first step, then only feed the newest token
+                    idx_cond = idx
+                    idx_new = idx if past_key_values is None else idx[:, -1:]
+                    logits, past_key_values = self.forward_with_cache(idx_new, past_key_values)
+                else:
+                    # if the sequence context is growing too long we must crop it at context_length. the
+                    # position embeddings of the window shift at every step, so cached keys/values are stale
+                    idx_cond = idx if idx.size(1) <= self.context_length else idx[:, -self.context_length :]
+                    # forward the model to get the logits for the index in the sequence
+                    logits, _ = self(idx_cond)
+                # pluck the logits at the final step and scale by desired temperature
+                logits = logits[:, -1, :] / (temperature + 1e-8)
+                if watermark_proccessor is not None:
+                    with record_function("watermark"):
+                        logits = watermark_proccessor(idx_cond, logits)
+                with record_function("sampling"):
+                    # optionally crop the logits to only the top k options
+                    if top_k is not None:
+                        logits[logits < torch.topk(logits, top_k)[0][:, [-1]]] = -float("Inf")
+                    # apply softmax to convert logits to (normalized) probabilities
+                    probs = F.softmax(logits, dim=-1)
+                    # either sample from the distribution or take the most likely element
+                    idx_next = (
+                        torch.multinomial(probs, num_samples=1) if do_sample else torch.topk(probs, k=1, dim=-1)[1]
+                    )
+                # append sampled index to the running sequence and continue
+                idx = torch.cat((idx, idx_next), dim=1)
+                profiling.profiler_step()
+                yield idx
+        finally:
+            # also runs when a consumer stops iterating early
+            if changed_training_mode:
+                self.train()
+
     def generate(
         self,
         idx: Union[List[int], torch.LongTensor],
@@ -66,36 +185,160 @@ class GPT(nn.Module):
         temperature: float = 1.0,
         do_sample: bool = False,
         top_k: Optional[int] = None,
-        as_list: bool = False, watermark_proccessor = None
+        as_list: bool = False,
+        watermark_proccessor=None,
+        use_cache: bool = True,
     ):
         idx = torch.as_tensor(idx, dtype=torch.long, device=self.device)[None, ...]
+        for idx in self._generate_tokens(
+            idx, num_generated_tokens, temperature, do_sample, top_k, watermark_proccessor, use_cache
+        ):
+            pass
+        return idx.cpu().squeeze().tolist() if as_list else idx
+
+    def stream(
+        self,
+        idx: Union[List[int], torch.LongTensor],
+        num_generated_tokens: int,
+        temperature: float = 1.0,
+        do_sample: bool = False,
+        top_k: Optional[int] = None,
+        watermark_proccessor=None,
+        use_cache: bool = True,
+        chords: bool = False,
+    ) -> Iterator[GenerationStep]:
+        """Lazily generate tokens, yielding each one as soon as it is sampled.
+
+        With chords=True, tokens are grouped into 4-voice tetrads aligned with the full (seed + generated)
+        sequence, and each chord is yielded once its last voice is sampled; a trailing incomplete chord is
+        not yielded. Stop iterating (or call close() on the generator) to cancel the remaining generation.
+        """
+        idx = torch.as_tensor(idx, dtype=torch.long, device=self.device)[None, ...]
+        start_time = previous_time = time.perf_counter()
+        pending_tokens, pending_seconds = [], []
+        for num_generated, idx in enumerate(
+            self._generate_tokens(
+                idx, num_generated_tokens, temperature, do_sample, top_k, watermark_proccessor, use_cache
+            ),
+            start=1,
+        ):
+            now = time.perf_counter()
+            pending_tokens.append(idx[0, -1].item())
+            pending_seconds.append(now - previous_time)
+            previous_time = now
+            if chords and idx.size(1) % 4 != 0:
+                continue
+            yield GenerationStep(
+                tokens=idx[0, -4:].tolist() if chords else pending_tokens,
+                num_generated=num_generated,
+                token_seconds=pending_seconds,
+                elapsed_seconds=now - start_time,
+            )
+            pending_tokens, pending_seconds = [], []
+
+    @torch.no_grad()
+    def generate_batch(
+        self,
+        seeds: List[Union[List[int], torch.LongTensor]],
+        num_generated_tokens: Union[int, List[int]],
+        temperature: Union[float, List[float]] = 1.0,
+        do_sample: bool = False,
+        top_k: Union[Optional[int], List[Optional[int]]] = None,
+        stop_token: Optional[int] = None,
+        as_list: bool = False,
+        watermark_proccessor=None,
+        use_cache: bool = True,
+    ):
+        """Generate continuations of several seeds of different lengths with one batched forward per step.
+
+        Seeds are left-padded and masked, so each sequence sees exactly what generate would show it. The
+        num_generated_tokens, temperature and top_k arguments take either one value for all sequences or one
+        value per sequence. A sequence finishes after its num_generated_tokens or when it samples stop_token,
+        and finished sequences are dropped from the active batch. Returns one 1D tensor (or list) per seed.
+        """
+        num_seqs = len(seeds)
+        num_generated_tokens = _per_sequence(num_generated_tokens, num_seqs, "num_generated_tokens")
+        temperature = _per_sequence(temperature, num_seqs, "temperature")
+        top_k = _per_sequence(top_k, num_seqs, "top_k")
+        seeds = [torch.as_tensor(seed, dtype=torch.long, device=self.device).flatten() for seed in seeds]
+        if any(len(seed) == 0 for seed in seeds):
+            raise ValueError("every seed must contain at least one token")
+
+        # left-pad the seeds so that the newest token of every sequence is in the last column
+        width = max(len(seed) for seed in seeds)
+        idx = torch.zeros(num_seqs, width, dtype=torch.long, device=self.device)
+        mask = torch.zeros(num_seqs, width, dtype=torch.bool, device=self.device)
+        for row, seed in enumerate(seeds):
+            idx[row, width - len(seed) :] = seed
+            mask[row, width - len(seed) :] = True
+
+        # per-sequence sampling state of the active rows
+        active = torch.arange(num_seqs, device=self.device)
+        remaining = torch.tensor(num_generated_tokens, device=self.device)
+        temperatures = torch.tensor(temperature, dtype=torch.float, device=self.device)[:, None]
+        top_ks = torch.tensor([self.lm_head.out_features if k is None else k for k in top_k], device=self.device)
+        outputs = [None] * num_seqs
+
         changed_training_mode = False
         if self.training:
             self.eval()
             changed_training_mode = True
-        for _ in range(num_generated_tokens):
-            # if the sequence context is growing too long we must crop it at context_length
-            idx_cond = idx if idx.size(1) <= self.context_length else idx[:, -self.context_length :]
-            # forward the model to get the logits for the index in the sequence
-            logits, _ = self(idx_cond)
-            # pluck the logits at the final step and scale by desired temperature
-            logits = logits[:, -1, :] / (temperature + 1e-8)
-            idx_cond, logits = idx_cond.cpu(), logits.cpu()
+        past_key_values = None
+        while True:
+            # retire finished rows and drop the leading columns that are now padding for every row
+            finished = remaining <= 0
+            if finished.any():
+                for row in finished.nonzero().flatten().tolist():
+                    outputs[active[row].item()] = idx[row][mask[row]]
+                keep = (~finished).nonzero().flatten()
+                active, remaining, temperatures, top_ks = (t[keep] for t in (active, remaining, temperatures, top_ks))
+                idx, mask = idx[keep], mask[keep]
+                if len(active) == 0:
+                    break
+                first_column = mask.any(dim=0).nonzero()[0].item()
+                idx, mask = idx[:, first_column:], mask[:, first_column:]
+                if past_key_values is not None:
+                    past_key_values = [
+                        (k[keep, :, first_column:], v[keep, :, first_column:]) for k, v in past_key_values
+                    ]
+
+            if past_key_values is not None:
+                # only feed the newest token of every row, at the position that follows its own prefix
+                position_ids = mask.sum(dim=1, keepdim=True) - 1
+                logits, past_key_values = self.forward_with_cache(
+                    idx[:, -1:], past_key_values, position_ids=position_ids, attention_mask=mask
+                )
+            else:
+                # prefill (or recompute once the longest row has outgrown context_length) the cropped window
+                idx_window, mask_window = idx[:, -self.context_length :], mask[:, -self.context_length :]
+                position_ids = (mask_window.cumsum(dim=1) - 1).clamp(min=0)
+                logits, past_key_values = self.forward_with_cache(
+                    idx_window, position_ids=position_ids, attention_mask=mask_window
+                )
+            if not use_cache or idx.size(1) >= self.context_length:
+                past_key_values = None
+
+            logits = logits[:, -1, :] / (temperatures + 1e-8)
             if watermark_proccessor is not None:
-                logits = watermark_proccessor(idx_cond, logits)
-            idx_cond, logits = idx_cond.to(idx.device), logits.to(idx.device)
-            # optionally crop the logits to only the top k options
-            if top_k is not None:
-                logits[logits < torch.topk(logits, top_k)[0][:, [-1]]] = -float("Inf")
-            # apply softmax to convert logits to (normalized) probabilities
-            probs = F.softmax(logits, dim=-1)
-            # either sample from the distribution or take the most likely element
-            idx_next = torch.multinomial(probs, num_samples=1) if do_sample else torch.topk(probs, k=1, dim=-1)[1]
-            # append sampled index to the running sequence and continue
+                with record_function("watermark"):
+                    logits = watermark_proccessor(idx, logits)
+            with record_function("sampling"):
+                # crop the logits of every row to its own top k options
+                kth_largest = torch.sort(logits, dim=-1, descending=True)[0].gather(1, top_ks[:, None] - 1)
+                logits[logits < kth_largest] = -float("Inf")
+                probs = F.softmax(logits, dim=-1)
+                idx_next = torch.multinomial(probs, num_samples=1) if do_sample else torch.topk(probs, k=1, dim=-1)[1]
+
             idx = torch.cat((idx, idx_next), dim=1)
+            mask = torch.cat((mask, torch.ones_like(idx_next, dtype=torch.bool)), dim=1)
+            remaining = remaining - 1
+            if stop_token is not None:
+                remaining[idx_next[:, 0] == stop_token] = 0
+            profiling.profiler_step()
+
         if changed_training_mode:
             self.train()
-        return idx.cpu().squeeze().tolist() if as_list else idx
+        return [output.cpu().tolist() for output in outputs] if as_list else outputs
 
     def save(self, path: Union[str, Path]):
         torch.save(self.state_dict(), path)
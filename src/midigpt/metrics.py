@@ -0,0 +1,107 @@
+import contextlib
+import json
+import time
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+import numpy as np
+import torch
+from torch.profiler import record_function
+
+__all__ = ["TrainingMetrics", "read_metrics"]
+
+_STAGES = ("data_wait", "forward", "backward", "optimizer")
+
+
+class TrainingMetrics:
+    """
+    Per-step training telemetry: the time spent waiting for data and in the forward pass, backward pass and
+    optimizer step, tokens/sec and the loss. Losses are accumulated on the device and only read back in flush,
+    so logging adds a single device sync per flush instead of one per step.
+
+    Every flush appends one JSON record per buffered step ("type": "step") to a JSONL file, and log appends
+    records of other types (e.g. eval interval summaries). Timings are host wall-clock times, which on
+    asynchronous devices (CUDA) include waiting for earlier kernels.
+    """
+
+    def __init__(self, path: Optional[Union[str, Path]] = None, num_processes: int = 1):
+        """
+        :param path: The JSONL file to append records to, None to only compute summaries.
+        :param num_processes: The number of data-parallel processes, each training on as many tokens per step.
+        """
+        self.path = None if path is None else Path(path)
+        self.num_processes = num_processes
+        self._steps = []
+        self._losses = []
+        self._clock = time.perf_counter()
+
+    def restart_clock(self):
+        """Exclude the time since the last step (e.g. evaluation or checkpointing) from the next data wait."""
+        self._clock = time.perf_counter()
+
+    def begin_step(self, **fields):
+        now = time.perf_counter()
+        self._steps.append({"type": "step", **fields, "data_wait": now - self._clock})
+        self._clock = now
+
+    @contextlib.contextmanager
+    def time(self, stage: str):
+        start = time.perf_counter()
+        try:
+            with record_function(stage):
+                yield
+        finally:
+            self._steps[-1][stage] = self._steps[-1].get(stage, 0.0) + time.perf_counter() - start
+
+    def end_step(self, loss: torch.Tensor, num_tokens: int):
+        now = time.perf_counter()
+        step = self._steps[-1]
+        step["tokens"] = num_tokens * self.num_processes
+        step["step_time"] = step["data_wait"] + now - self._clock
+        step["tokens_per_sec"] = step["tokens"] / step["step_time"]
+        self._losses.append(loss.detach())
+        self._clock = now
+
+    def flush(self, write: bool = True) -> Optional[Dict[str, float]]:
+        """
+        Read back the buffered losses, append the buffered steps to the JSONL file and clear the buffer.
+
+        :param write: Whether to write the records, e.g. False on all but one data-parallel process.
+        :return: The mean loss, tokens/sec and stage timings over the flushed steps, None if there were none.
+        """
+        if not self._steps:
+            return None
+        losses = torch.stack(self._losses).float().cpu().tolist()
+        for step, loss in zip(self._steps, losses):
+            step["loss"] = loss
+        if write:
+            self._write(self._steps)
+        summary = {
+            "loss": float(np.mean(losses)),
+            "tokens_per_sec": sum(step["tokens"] for step in self._steps) / sum(s["step_time"] for s in self._steps),
+            **{stage: float(np.mean([step.get(stage, 0.0) for step in self._steps])) for stage in _STAGES},
+        }
+        self._steps, self._losses = [], []
+        return summary
+
+    def log(self, record_type: str, **fields):
+        self._write([{"type": record_type, **fields}])
+
+    def _write(self, records):
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.writelines(json.dumps(record) + "\n" for record in records)
+
+
+def read_metrics(path: Union[str, Path], record_type: str = "step") -> Dict[str, np.ndarray]:
+    """
+    Read the records of one type from a metrics JSONL file as columns, ready to plot.
+
+    :return: A dict from field name to an array with a value per record (NaN where a record lacks the field).
+    """
+    with open(path) as f:
+        records = [record for record in map(json.loads, f) if record.get("type") == record_type]
+    fields = dict.fromkeys(key for record in records for key in record if key != "type")
+    return {key: np.array([record.get(key, np.nan) for record in records]) for key in fields}
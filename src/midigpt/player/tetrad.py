@@ -16,16 +16,40 @@ must be equal to 2. So r=2^(1/12). All of this gives us the equation to find the
 its index: frequency = 440 * 2**((note - 69)/12). 
 """
 
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from IPython.display import Audio, display
 from scipy.io import wavfile
-from scipy.fft import rfft, rfftfreq
+from scipy.fft import irfft, rfft, rfftfreq
 from scipy.signal import find_peaks
 import io
+import struct
+import wave
 
 
 __all__ = ["TetradPlayer"]
 
+# MIDI time resolution, one chord lasts one quarter note
+_MIDI_TICKS_PER_BEAT = 480
+_MIDI_VELOCITY = 80
+
+# onset envelope frames transformed per block
+_ONSET_BLOCK_SIZE = 2048
+
+# chords rendered per block, bounds the temporary memory of rendering to a few MB
+_RENDER_BLOCK_SIZE = 64
+
+
+@functools.lru_cache(maxsize=128)
+def _note_waveform(note: int, tempo: float, sample_rate: int) -> np.ndarray:
+    """One beat of a note, exactly as rendered by TetradPlayer.frequencies_to_samples."""
+    frequencies = TetradPlayer.notes_to_frequencies([note])
+    waveform = TetradPlayer.frequencies_to_samples(frequencies, tempo, sample_rate)
+    waveform.flags.writeable = False
+    return waveform
+
 
 class TetradPlayer:
     def __init__(self, sample_rate=44100, tempo=120, amplitude=0.1):
@@ -52,16 +76,97 @@ class TetradPlayer:
         sine_waves *= (frequencies > 9.0).reshape(-1, 1)
         return sine_waves.reshape(-1)
 
+    @staticmethod
+    def _chord_wavetable(chords, tempo, sample_rate):
+        # look up every distinct note's waveform once, so chords can be rendered by indexing
+        unique_notes, note_indices = np.unique(chords, return_inverse=True)
+        wavetable = np.stack([_note_waveform(int(note), tempo, sample_rate) for note in unique_notes])
+        return wavetable, note_indices.reshape(chords.shape)
+
+    @staticmethod
+    def _render_chords(wavetable, note_indices, out):
+        # out has shape (n_chords, samples per beat) and receives the mean of the voices of every chord
+        for start in range(0, len(note_indices), _RENDER_BLOCK_SIZE):
+            block = out[start : start + _RENDER_BLOCK_SIZE]
+            block_indices = note_indices[start : start + _RENDER_BLOCK_SIZE]
+            np.take(wavetable, block_indices[:, 0], axis=0, out=block)
+            for voice in range(1, note_indices.shape[1]):
+                block += wavetable[block_indices[:, voice]]
+            block /= note_indices.shape[1]
+
+    @staticmethod
+    def _fade_out(samples, offset, n_total_samples, tempo, sample_rate):
+        # fade out the last note, where samples start at the offset-th of n_total_samples samples
+        n_fade_out_samples = sample_rate * 60 // tempo
+        fade_start = n_total_samples - n_fade_out_samples
+        if offset + len(samples) > fade_start:
+            first = max(fade_start - offset, 0)
+            fade_out = np.linspace(1.0, 0.0, n_fade_out_samples) ** 2
+            samples[first:] *= fade_out[offset + first - fade_start :][: len(samples) - first]
+
     @classmethod
-    def chords_to_samples(cls, chords, tempo, sample_rate, amplitude=1.0):
-        freqs = cls.notes_to_frequencies(chords)
-        # freqs = np.r_[freqs, freqs[-1:]]  # make last note a bit longer
-        merged = np.mean([cls.frequencies_to_samples(melody, tempo, sample_rate) for melody in freqs.T], axis=0)
-        n_fade_out_samples = sample_rate * 60 // tempo  # fade out last note
-        fade_out = np.linspace(1.0, 0.0, n_fade_out_samples) ** 2
-        merged[-n_fade_out_samples:] *= fade_out
-        return amplitude * merged
-    
+    def chords_to_samples(cls, chords, tempo, sample_rate, amplitude=1.0, out=None):
+        """
+        Render chords by summing cached one-beat note waveforms into a single output buffer.
+
+        :param chords: Array of shape (n_chords, n_voices) with MIDI note numbers.
+        :param out: Optional preallocated float64 buffer of n_chords * samples-per-beat samples to render into.
+        :return: The rendered samples.
+        """
+        chords = np.asarray(chords)
+        n_samples = int(60 / tempo * sample_rate)
+        if out is None:
+            out = np.empty(len(chords) * n_samples)
+        wavetable, note_indices = cls._chord_wavetable(chords, tempo, sample_rate)
+        cls._render_chords(wavetable, note_indices, out.reshape(len(chords), n_samples))
+        cls._fade_out(out, 0, len(out), tempo, sample_rate)
+        out *= amplitude
+        return out
+
+    @classmethod
+    def iter_int16_chunks(cls, chords, tempo, sample_rate, amplitude=1.0, chords_per_chunk=64):
+        """
+        Render chords into 16-bit PCM chunks of chords_per_chunk chords each.
+
+        Only one chunk is held in memory at a time, and the concatenated chunks equal the int16
+        conversion of chords_to_samples.
+        """
+        chords = np.asarray(chords)
+        n_samples = int(60 / tempo * sample_rate)
+        wavetable, note_indices = cls._chord_wavetable(chords, tempo, sample_rate)
+        buffer = np.empty((min(chords_per_chunk, len(chords)), n_samples))
+        for start in range(0, len(chords), chords_per_chunk):
+            chunk_indices = note_indices[start : start + chords_per_chunk]
+            chunk = buffer[: len(chunk_indices)]
+            cls._render_chords(wavetable, chunk_indices, chunk)
+            samples = chunk.reshape(-1)
+            cls._fade_out(samples, start * n_samples, len(chords) * n_samples, tempo, sample_rate)
+            samples *= amplitude
+            yield (2**15 * samples).astype(np.int16)
+
+    def iter_wav_bytes(self, chords, chords_per_chunk=64, **kwargs):
+        """
+        Yield a mono 16-bit WAV file piece by piece: first the header, then the samples chunk by chunk.
+
+        Can be passed straight to a Flask Response to stream the audio as it is rendered.
+        """
+        sampling_kwargs = self._get_sampling_kwargs(**kwargs)
+        sample_rate = sampling_kwargs["sample_rate"]
+        n_data_bytes = 2 * len(chords) * int(60 / sampling_kwargs["tempo"] * sample_rate)
+        yield b"".join(
+            [
+                b"RIFF",
+                struct.pack("<I", 36 + n_data_bytes),
+                b"WAVE",
+                b"fmt ",
+                struct.pack("<IHHIIHH", 16, 1, 1, sample_rate, 2 * sample_rate, 2, 16),
+                b"data",
+                struct.pack("<I", n_data_bytes),
+            ]
+        )
+        for chunk in self.iter_int16_chunks(chords, chords_per_chunk=chords_per_chunk, **sampling_kwargs):
+            yield chunk.astype("<i2", copy=False).tobytes()
+
     @staticmethod
     def samples_to_frequencies(samples, sample_rate):
         """
@@ -86,7 +191,56 @@ class TetradPlayer:
         return dominant_frequencies
     
     @classmethod
-    def samples_to_chords(cls, samples, tempo, sample_rate, amplitude=1.0):
+    def frames_to_chords(cls, frames, sample_rate, workers=-1):
+        """
+        Convert a (num_beats, samples_per_beat) matrix of beat frames to chords with one batched FFT.
+
+        The FFTs themselves dominate the cost, so on one core this is only about 1.1-1.2x faster than decoding
+        beat by beat (benchmarks/decode_chords.py); workers=-1 spreads the FFT over all cores.
+
+        :param frames: The audio samples of every beat, one beat per row.
+        :param sample_rate: The sample rate used to generate the samples.
+        :param workers: Number of threads for the FFT, -1 uses all cores.
+        :return: An array of shape (num_beats, 4) with the MIDI note numbers of each chord in descending
+            order, padded at the front with -1 when fewer than four notes are found.
+        """
+        num_beats, samples_per_beat = frames.shape
+        magnitudes = np.abs(rfft(frames, axis=-1, workers=workers))
+        frequencies = rfftfreq(samples_per_beat, 1 / sample_rate)
+        with np.errstate(divide="ignore"):
+            bin_notes = np.round(69 + 12 * np.log2(frequencies / 440))
+        bin_notes[0] = -1  # the DC bin is never a peak
+
+        # peaks are strict local maxima above 5% of the beat's max magnitude, like find_peaks with a height
+        heights = magnitudes.max(axis=-1, keepdims=True) / 20
+        center = magnitudes[:, 1:-1]
+        is_peak = (center > magnitudes[:, :-2]) & (center > magnitudes[:, 2:]) & (center >= heights)
+        # find_peaks also reports the middle of flat peaks, so beats with plateaus take the per-beat path
+        has_plateau = ((center == magnitudes[:, 2:]) & (center >= heights) & (center > 0)).any(axis=-1)
+
+        # bin notes increase with frequency, so each beat's unique sorted notes are its peak notes without repeats
+        beats, bins = np.nonzero(is_peak)
+        notes = bin_notes[bins + 1].astype(int)
+        # (the leading True is sliced off again when there are no peaks at all, e.g. in silence)
+        is_new = np.r_[True, (beats[1:] != beats[:-1]) | (notes[1:] != notes[:-1])][: len(beats)]
+        beats, notes = beats[is_new], notes[is_new]
+        first_of_beat = np.r_[True, beats[1:] != beats[:-1]][: len(beats)]
+        beat_starts = np.flatnonzero(first_of_beat)
+        rank = np.arange(len(beats)) - np.repeat(beat_starts, np.diff(np.r_[beat_starts, len(beats)]))
+        keep = rank < 4  # if more than four notes, keep the four lowest
+        chords = np.full((num_beats, 4), -1, dtype=int)
+        chords[beats[keep], rank[keep]] = notes[keep]
+
+        for beat in np.flatnonzero(has_plateau):
+            beat_frequencies = cls.samples_to_frequencies(frames[beat], sample_rate)
+            unique_notes = np.unique(np.round(69 + 12 * np.log2(beat_frequencies / 440)).astype(int))[:4]
+            chords[beat] = np.pad(unique_notes, (0, 4 - len(unique_notes)), constant_values=-1)
+
+        # reverse the notes of every chord
+        return np.ascontiguousarray(chords[:, ::-1])
+
+    @classmethod
+    def samples_to_chords(cls, samples, tempo, sample_rate, amplitude=1.0, offset=0):
         """
         Convert samples back to chords, ensuring each chord array has a fixed length.
 
@@ -94,35 +248,147 @@ class TetradPlayer:
         :param tempo: The tempo at which the samples were generated.
         :param sample_rate: The sample rate used to generate the samples.
         :param amplitude: The amplitude of the audio samples.
+        :param offset: The sample at which the first beat starts, e.g. from estimate_beat_grid.
         :return: An array of chord arrays, each containing MIDI note numbers.
         """
-        # tempo = 220
-        print("TEMPO: ", tempo)
         beat_duration = 60 / tempo  # duration of one beat in seconds
         samples_per_beat = int(sample_rate * beat_duration)
+        samples = np.asarray(samples)[offset:]
         num_beats = len(samples) // samples_per_beat
-        chords = []
-        
-        for i in range(num_beats):
-            beat_samples = samples[i * samples_per_beat:(i + 1) * samples_per_beat]
-            frequencies = cls.samples_to_frequencies(beat_samples, sample_rate)
-            
-            # Convert frequencies to MIDI note numbers
-            notes = np.round(69 + 12 * np.log2(frequencies / 440)).astype(int)
-            unique_notes = np.unique(notes)
-            
-            # Ensure the array has exactly four elements, padding if necessary
-            padded_notes = np.pad(unique_notes, (0, max(0, 4 - len(unique_notes))), mode='constant', constant_values=-1)
-            if len(padded_notes) > 4:  # If more than four notes, trim to four
-                padded_notes = padded_notes[:4]
-            chords.append(padded_notes)
-        
-        # reverse the chords and return (reverse the subarray)
-        for i in range(len(chords)):
-            chords[i] = chords[i][::-1]
-        return np.array(chords)
-    
-    
+        frames = samples[: num_beats * samples_per_beat].reshape(num_beats, samples_per_beat)
+        return cls.frames_to_chords(frames, sample_rate)
+
+    @staticmethod
+    def onset_strength(samples, sample_rate, hop_length=256, frame_length=2048):
+        """
+        Spectral flux onset envelope: the summed increase of the log magnitude spectrum between frames.
+
+        :return: The envelope and the sample position (frame center) of each of its values.
+        """
+        samples = np.asarray(samples, dtype=np.float64)
+        n_frames = max((len(samples) - frame_length) // hop_length + 1, 0)
+        if n_frames == 0:
+            return np.zeros(0), np.zeros(0)
+        frames = np.lib.stride_tricks.sliding_window_view(samples, frame_length)[::hop_length]
+        window = np.hanning(frame_length)
+        envelope = np.zeros(n_frames)
+        previous = None
+        for start in range(0, n_frames, _ONSET_BLOCK_SIZE):
+            log_magnitudes = np.log1p(np.abs(rfft(frames[start : start + _ONSET_BLOCK_SIZE] * window, axis=-1)))
+            previous = log_magnitudes[:1] if previous is None else previous
+            flux = np.diff(np.concatenate((previous, log_magnitudes)), axis=0)
+            envelope[start : start + _ONSET_BLOCK_SIZE] = np.maximum(flux, 0).sum(axis=-1)
+            previous = log_magnitudes[-1:]
+        return envelope, np.arange(n_frames) * hop_length + frame_length / 2
+
+    @staticmethod
+    def _comb_beat_offset(envelope, envelope_positions, n_samples, samples_per_beat, hop_length):
+        # the grid phase whose beat boundaries collect the most onset strength on average
+        offsets = np.arange(0, samples_per_beat, hop_length / 2)
+        boundaries = offsets[:, None] + np.arange(n_samples // samples_per_beat + 1) * samples_per_beat
+        scores = np.interp(boundaries, envelope_positions, envelope, left=0, right=0).mean(axis=1)
+        best = np.argmax(scores)
+        return scores[best], int(offsets[best])
+
+    @staticmethod
+    def _beat_grid_concentration(samples, samples_per_beat, offset, n_voices=4, n_beats=8):
+        # fraction of the power of sampled beats in their n_voices strongest bins. beats of a well aligned
+        # grid hold one chord of sines with a whole number of cycles each, so this is close to 1
+        n_usable_beats = len(samples) // samples_per_beat - 2  # the same beats are usable for any offset
+        if n_usable_beats < 1:
+            return 0.0
+        beats = np.linspace(0, n_usable_beats - 1, min(n_beats, n_usable_beats)).astype(int)
+        frames = np.stack([samples[offset + b * samples_per_beat : offset + (b + 1) * samples_per_beat] for b in beats])
+        power = np.abs(rfft(frames.astype(np.float64), axis=-1, workers=1)) ** 2
+        total = power.sum(axis=-1)
+        top = np.partition(power, -n_voices, axis=-1)[:, -n_voices:].sum(axis=-1)
+        return float(np.mean(top[total > 0] / total[total > 0])) if (total > 0).any() else 0.0
+
+    @classmethod
+    def _search_beat_offset(cls, samples, samples_per_beat, offset, steps):
+        # coarse to fine search of the grid phase around offset, with (step, radius) pairs in samples
+        for step, radius in steps:
+            offsets = np.unique((offset + np.arange(-radius, radius + 1, step)) % samples_per_beat)
+            scores = np.array([cls._beat_grid_concentration(samples, samples_per_beat, o) for o in offsets])
+            # the edges of beats are ~0, so equally good offsets form a plateau: take its first one
+            offset = int(offsets[np.flatnonzero(scores >= scores.max() - 1e-6)[0]])
+        if offset > samples_per_beat - samples_per_beat // 32:
+            offset = 0  # a boundary just before the first sample, don't drop the nearly whole first beat
+        return offset, float(scores.max())
+
+    @classmethod
+    def _best_beat_grid(cls, samples, sample_rate, tempos, hop_length=256, max_workers=None, onsets=None):
+        # phase every candidate tempo with the onset comb, then score their grids concurrently
+        if onsets is None:
+            onsets = cls.onset_strength(samples, sample_rate, hop_length=hop_length)
+        envelope, envelope_positions = onsets
+        candidates = []
+        for tempo in tempos:
+            samples_per_beat = int(sample_rate * (60 / tempo))
+            _, offset = cls._comb_beat_offset(envelope, envelope_positions, len(samples), samples_per_beat, hop_length)
+            candidates.append((tempo, samples_per_beat, offset))
+
+        def score(candidate):
+            tempo, samples_per_beat, offset = candidate
+            steps = [(hop_length // 2, 4 * hop_length)]
+            offset, score = cls._search_beat_offset(samples, samples_per_beat, offset, steps)
+            return score, tempo, samples_per_beat, offset
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            _, tempo, samples_per_beat, offset = max(executor.map(score, candidates))
+        steps = [(hop_length // 16, hop_length // 2), (4, 16), (1, 4)]
+        offset, score = cls._search_beat_offset(samples, samples_per_beat, offset, steps)
+        return tempo, offset, score
+
+    @classmethod
+    def estimate_beat_grid(cls, samples, sample_rate, min_tempo=40, max_tempo=300, hop_length=256, max_workers=None):
+        """
+        Estimate the tempo and the phase of the beat grid of rendered chords in one pass over the signal.
+
+        The autocorrelation of the onset envelope gives a coarse beat period. The integer tempo around that
+        period and each of its harmonics whose grid best matches the onsets is then scored by how cleanly
+        its beats decode, which resolves octave errors, and the phase of the winner is refined to the sample.
+
+        :return: The tempo in beats per minute and the sample at which the first whole beat starts.
+        """
+        samples = np.asarray(samples)
+        envelope, envelope_positions = cls.onset_strength(samples, sample_rate, hop_length=hop_length)
+        min_lag = int(60 / max_tempo * sample_rate / hop_length)
+        max_lag = min(int(np.ceil(60 / min_tempo * sample_rate / hop_length)), len(envelope) - 1)
+        if max_lag <= min_lag:
+            raise ValueError("not enough samples to estimate the beat grid")
+        if not envelope.any():
+            raise ValueError("no onsets to estimate the beat grid from")
+        centered = envelope - envelope.mean()
+        autocorrelation = irfft(np.abs(rfft(centered, 2 * len(centered))) ** 2)[: len(centered)]
+        lag = min_lag + np.argmax(autocorrelation[min_lag : max_lag + 1])
+
+        def comb_score(tempo):
+            samples_per_beat = int(sample_rate * (60 / tempo))
+            return cls._comb_beat_offset(envelope, envelope_positions, len(samples), samples_per_beat, hop_length)[0]
+
+        # tempos are whole numbers of beats per minute, so snap each harmonic of the period to the best one
+        tempos = []
+        for harmonic in (1 / 3, 1 / 2, 1, 2, 3):
+            center = 60 * sample_rate / (lag * hop_length) * harmonic
+            candidates = range(max(min_tempo, int(0.97 * center)), min(max_tempo, int(np.ceil(1.03 * center))) + 1)
+            if len(candidates) > 0:
+                tempos.append(max(candidates, key=comb_score))
+        onsets = (envelope, envelope_positions)
+        tempo, offset, _ = cls._best_beat_grid(samples, sample_rate, tempos, hop_length, max_workers, onsets)
+        return tempo, offset
+
+    @classmethod
+    def decode_best_tempo(cls, samples, sample_rate, tempos, max_workers=None):
+        """
+        Decode the samples at whichever candidate tempo gives the cleanest beats, scoring them concurrently.
+
+        :return: A dict with the chords, the tempo, the beat grid offset and the grid's score.
+        """
+        samples = np.asarray(samples)
+        tempo, offset, score = cls._best_beat_grid(samples, sample_rate, tempos, max_workers=max_workers)
+        chords = cls.samples_to_chords(samples, tempo, sample_rate, offset=offset)
+        return dict(chords=chords, tempo=tempo, offset=offset, score=score)
 
     def _get_sampling_kwargs(self, **kwargs):
         return dict(
@@ -140,24 +406,230 @@ class TetradPlayer:
 
     """
     @param chords is torch tensor of shape (n_chords, 4)
+    @param file_path is a path or a writable binary file object
     """
     def to_wav(self, chords, file_path, **kwargs):
-        samples = self.chords_to_samples(chords, **self._get_sampling_kwargs(**kwargs))
-        samples = (2**15 * samples).astype(np.int16)
-        wavfile.write(file_path, kwargs.get("sample_rate", self.sample_rate), samples)
-    
-    
-    def to_wav_buffer(self, chords, file_path, **kwargs):
-        samples = self.chords_to_samples(chords, **self._get_sampling_kwargs(**kwargs))
-        samples = (2**15 * samples).astype(np.int16)
+        if hasattr(file_path, "write"):
+            file_path.writelines(self.iter_wav_bytes(chords, **kwargs))
+        else:
+            with open(file_path, "wb") as f:
+                f.writelines(self.iter_wav_bytes(chords, **kwargs))
+
+    def to_wav_buffer(self, chords, file_path=None, **kwargs):
         buffer = io.BytesIO()
-        wavfile.write(buffer, kwargs.get("sample_rate", self.sample_rate), samples)
+        self.to_wav(chords, buffer, **kwargs)
         buffer.seek(0)
         return buffer
 
+    @staticmethod
+    def _open_wav(source):
+        # returns the sample rate and a function that reads the next n (mono) samples. paths are
+        # memory-mapped, file objects (e.g. io.BytesIO or an upload stream) of 8/16/32-bit integer PCM are
+        # read incrementally and any other format (float, 24-bit) is read whole by wavfile.read
+        wav = None
+        if hasattr(source, "read"):
+            start = source.tell()
+            try:
+                wav = wave.open(source, "rb")
+            except wave.Error:
+                pass
+            if wav is None or wav.getsampwidth() not in (1, 2, 4):
+                wav = None
+                source.seek(start)
+
+        if wav is not None:
+            sample_rate = wav.getframerate()
+            dtype = {1: np.uint8, 2: "<i2", 4: "<i4"}[wav.getsampwidth()]
+            n_channels = wav.getnchannels()
+
+            def read_samples(n_samples):
+                samples = np.frombuffer(wav.readframes(n_samples), dtype=dtype)
+                return samples.reshape(-1, n_channels) if n_channels > 1 else samples
+
+        else:
+            if hasattr(source, "read"):
+                sample_rate, memmapped_samples = wavfile.read(source)
+            else:
+                try:
+                    sample_rate, memmapped_samples = wavfile.read(source, mmap=True)
+                except ValueError:
+                    # 24-bit samples can't be memory-mapped
+                    sample_rate, memmapped_samples = wavfile.read(source)
+            position = 0
+
+            def read_samples(n_samples):
+                nonlocal position
+                samples = memmapped_samples[position : position + n_samples]
+                position += len(samples)
+                return samples
+
+        def read_mono_samples(n_samples):
+            samples = read_samples(n_samples)
+            return samples.mean(axis=1) if samples.ndim > 1 else samples
+
+        return sample_rate, read_mono_samples
+
+    def iter_wav_chords(self, source, beats_per_chunk=256, **kwargs):
+        """
+        Decode a WAV file chunk by chunk, so memory is bounded by beats_per_chunk beats of audio.
+
+        :param source: A WAV file path, which is memory-mapped, or a readable binary file object.
+        :return: An iterator over arrays of at most beats_per_chunk chords, like samples_to_chords returns.
+        """
+        sample_rate, read_samples = self._open_wav(source)
+        beat_duration = 60 / kwargs.get("tempo", self.tempo)  # duration of one beat in seconds
+        samples_per_beat = int(sample_rate * beat_duration)
+        read_samples(kwargs.get("offset", 0))
+        while True:
+            samples = read_samples(beats_per_chunk * samples_per_beat)
+            num_beats = len(samples) // samples_per_beat
+            if num_beats == 0:
+                break
+            frames = np.asarray(samples[: num_beats * samples_per_beat]).reshape(num_beats, samples_per_beat)
+            yield self.frames_to_chords(frames, sample_rate)
+            if num_beats < beats_per_chunk:
+                break
+
     def from_wav(self, file_path, **kwargs):
-        sample_rate, samples = wavfile.read(file_path)
-        # print("Sample rate: ", sample_rate)
-        # print("Samples: ", samples)
-        chords = self.samples_to_chords(samples, **self._get_sampling_kwargs(sample_rate=sample_rate, **kwargs))
+        chunks = list(self.iter_wav_chords(file_path, **kwargs))
+        return np.concatenate(chunks) if chunks else np.full((0, 4), -1, dtype=int)
+
+    def estimate_wav_beat_grid(self, source, max_seconds=60, **kwargs):
+        """
+        Estimate the tempo and beat grid offset of a WAV file from at most its first max_seconds of audio.
+
+        The position of a file object source is restored, so it can be decoded afterwards, e.g. with
+        iter_wav_chords(source, tempo=tempo, offset=offset).
+
+        :return: The tempo in beats per minute and the sample at which the first whole beat starts.
+        """
+        position = source.tell() if hasattr(source, "read") else None
+        sample_rate, read_samples = self._open_wav(source)
+        samples = np.asarray(read_samples(int(max_seconds * sample_rate)))
+        if position is not None:
+            source.seek(position)
+        return self.estimate_beat_grid(samples, sample_rate, **kwargs)
+
+    @staticmethod
+    def _midi_variable_length(value):
+        encoded = [value & 0x7F]
+        value >>= 7
+        while value:
+            encoded.append(0x80 | (value & 0x7F))
+            value >>= 7
+        return bytes(reversed(encoded))
+
+    def to_midi(self, chords, file_path, **kwargs):
+        """
+        Write chords to a standard MIDI file, one chord per beat at the player's tempo.
+
+        Every voice is written to its own channel, so voices (including unisons) round-trip exactly
+        through from_midi. Notes outside 1-127 are written as rests.
+
+        :param chords: Array of shape (n_chords, n_voices) with MIDI note numbers, at most 16 voices.
+        :param file_path: A path or a writable binary file object.
+        """
+        chords = np.asarray(chords)
+        tempo = kwargs.get("tempo", self.tempo)
+        events = [(0, b"\xff\x51\x03" + round(60_000_000 / tempo).to_bytes(3, "big"))]  # set tempo
+        for beat, chord in enumerate(chords.tolist()):
+            start, end = beat * _MIDI_TICKS_PER_BEAT, (beat + 1) * _MIDI_TICKS_PER_BEAT
+            for voice, note in enumerate(chord):
+                if 0 < note < 128:
+                    events.append((start, bytes([0x90 | voice, note, _MIDI_VELOCITY])))
+                    events.append((end, bytes([0x80 | voice, note, 0])))
+        # note offs sort before the note ons of the next beat
+        events.sort(key=lambda event: (event[0], event[1][0] & 0xF0 != 0x80))
+        events.append((len(chords) * _MIDI_TICKS_PER_BEAT, b"\xff\x2f\x00"))  # end of track
+
+        track, previous_tick = [], 0
+        for tick, event in events:
+            track.append(self._midi_variable_length(tick - previous_tick) + event)
+            previous_tick = tick
+        track = b"".join(track)
+        header = b"MThd" + struct.pack(">IHHH", 6, 0, 1, _MIDI_TICKS_PER_BEAT)
+        midi = header + b"MTrk" + struct.pack(">I", len(track)) + track
+
+        if hasattr(file_path, "write"):
+            file_path.write(midi)
+        else:
+            with open(file_path, "wb") as f:
+                f.write(midi)
+
+    @classmethod
+    def from_midi(cls, file_path, n_voices=4):
+        """
+        Read the chords of a standard MIDI file, one chord per beat.
+
+        Notes are assigned to voices by channel, as written by to_midi. For other files, the notes
+        starting in each beat are assigned to voices from the highest to the lowest.
+
+        :param file_path: A path or a readable binary file object.
+        :return: An array of shape (n_beats, n_voices) with MIDI note numbers, 0 for rests.
+        """
+        if hasattr(file_path, "read"):
+            midi = file_path.read()
+        else:
+            with open(file_path, "rb") as f:
+                midi = f.read()
+        if midi[:4] != b"MThd":
+            raise ValueError("not a standard MIDI file")
+        header_length, _, n_tracks, ticks_per_beat = struct.unpack(">IHHH", midi[4:14])
+        if ticks_per_beat & 0x8000:
+            raise ValueError("SMPTE time division is not supported")
+
+        notes, end_tick, position = [], 0, 8 + header_length
+        for _ in range(n_tracks):
+            chunk_type = midi[position : position + 4]
+            (chunk_length,) = struct.unpack(">I", midi[position + 4 : position + 8])
+            position += 8
+            track_end = position + chunk_length
+            if chunk_type != b"MTrk":
+                position = track_end
+                continue
+            tick, status = 0, None
+            while position < track_end:
+                delta = 0
+                while True:
+                    byte = midi[position]
+                    position += 1
+                    delta = (delta << 7) | (byte & 0x7F)
+                    if byte < 0x80:
+                        break
+                tick += delta
+                if midi[position] >= 0x80:
+                    status = midi[position]
+                    position += 1
+                if status == 0xFF or status in (0xF0, 0xF7):
+                    if status == 0xFF:
+                        position += 1  # meta event type
+                    length = 0
+                    while True:
+                        byte = midi[position]
+                        position += 1
+                        length = (length << 7) | (byte & 0x7F)
+                        if byte < 0x80:
+                            break
+                    position += length
+                    status = None  # running status is cancelled by meta and sysex events
+                    continue
+                n_data_bytes = 1 if status & 0xF0 in (0xC0, 0xD0) else 2
+                data = midi[position : position + n_data_bytes]
+                position += n_data_bytes
+                if status & 0xF0 == 0x90 and data[1] > 0:
+                    notes.append((tick // ticks_per_beat, status & 0x0F, data[0]))
+            end_tick = max(end_tick, tick)
+
+        n_beats = max(-(-end_tick // ticks_per_beat), max((beat + 1 for beat, _, _ in notes), default=0))
+        chords = np.zeros((n_beats, n_voices), dtype=int)
+        voices_are_channels = all(channel < n_voices for _, channel, _ in notes)
+        voices_are_channels &= len({(beat, channel) for beat, channel, _ in notes}) == len(notes)
+        if voices_are_channels:
+            for beat, channel, note in notes:
+                chords[beat, channel] = note
+        else:
+            for beat in sorted({beat for beat, _, _ in notes}):
+                beat_notes = sorted((note for b, _, note in notes if b == beat), reverse=True)[:n_voices]
+                chords[beat, : len(beat_notes)] = beat_notes
         return chords
+
@@ -0,0 +1,62 @@
+import contextlib
+from pathlib import Path
+from typing import Union
+
+import torch
+from torch.profiler import ProfilerActivity
+
+__all__ = ["profile", "profiler_step"]
+
+# the profilers of the active profile contexts, innermost last
+_profilers = []
+
+
+@contextlib.contextmanager
+def profile(
+    output_dir: Union[str, Path],
+    wait: int = 1,
+    warmup: int = 1,
+    active: int = 3,
+    record_shapes: bool = False,
+    profile_memory: bool = False,
+    sort_by: str = "self_cpu_time_total",
+    row_limit: int = 40,
+):
+    """
+    Profile a bounded window of steps with torch.profiler, e.g.
+
+        with profile("profiles"):
+            model.generate(seed, 64)
+
+    Steps are marked with profiler_step(), which Trainer.train calls after every training step and GPT.generate
+    after every token. The first wait steps are skipped, the next warmup steps are profiled but discarded and
+    the following active steps are recorded. The recorded window is written to output_dir as a Chrome trace
+    (trace_<step>.json, open it in chrome://tracing or Perfetto) and a per-op summary table (ops_<step>.txt).
+    """
+    output_dir = Path(output_dir)
+    activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if torch.cuda.is_available() else [])
+
+    def export(profiler):
+        output_dir.mkdir(parents=True, exist_ok=True)
+        profiler.export_chrome_trace(str(output_dir / f"trace_{profiler.step_num}.json"))
+        with open(output_dir / f"ops_{profiler.step_num}.txt", "w") as f:
+            f.write(profiler.key_averages().table(sort_by=sort_by, row_limit=row_limit))
+
+    with torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+        on_trace_ready=export,
+        record_shapes=record_shapes,
+        profile_memory=profile_memory,
+    ) as profiler:
+        _profilers.append(profiler)
+        try:
+            yield profiler
+        finally:
+            _profilers.remove(profiler)
+
+
+def profiler_step():
+    """Mark the end of a step for the innermost active profile context, if there is one."""
+    if _profilers:
+        _profilers[-1].step()
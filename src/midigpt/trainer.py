@@ -1,22 +1,76 @@
+import contextlib
+import itertools
+import json
+import math
 import warnings
 from pathlib import Path
 from typing import Optional, Union
 
 import torch
-from torch.utils.data import DataLoader, Subset
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.profiler import record_function
+from torch.utils.data import DataLoader, DistributedSampler, Sampler, Subset
 from tqdm.rich import tqdm
 from tqdm.std import TqdmExperimentalWarning
 
-from . import utils
-from .config import ModelConfigure, TrainConfigure
+from . import profiling, utils
+from .checkpointing import CheckpointWriter, get_rng_states, list_checkpoints, set_rng_states
+from .config import TrainConfigure
 from .datasets import DatasetType
+from .evaluation import Evaluator
 from .gpt import GPT
+from .metrics import TrainingMetrics
 
 __all__ = ["Trainer"]
 
 warnings.simplefilter("ignore", TqdmExperimentalWarning)
 
 
+class _EpochSampler(Sampler):
+    # the same order for the same epoch and seed (sharded across processes under torch.distributed), which
+    # can start partway through an epoch, so a resumed run sees exactly the batches it would have seen
+    def __init__(self, dataset: DatasetType, shuffle: bool, seed: int):
+        self.sampler = DistributedSampler(
+            dataset, num_replicas=utils.get_world_size(), rank=utils.get_rank(), shuffle=shuffle, seed=seed
+        )
+        self.start = 0
+
+    def set_epoch(self, epoch: int, start: int = 0):
+        self.sampler.set_epoch(epoch)
+        self.start = start
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def __iter__(self):
+        return itertools.islice(iter(self.sampler), self.start, None)
+
+
+class _BatchLoader:
+    # loads batches from datasets with a get_batch method, one indexing operation per batch instead of
+    # one __getitem__ call per sample and a collate
+    def __init__(self, dataset: DatasetType, batch_size: int, sampler: Sampler):
+        self.indices = None
+        if isinstance(dataset, Subset):
+            self.indices = torch.as_tensor(dataset.indices)
+            dataset = dataset.dataset
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.sampler = sampler
+
+    def __len__(self):
+        return math.ceil(len(self.sampler) / self.batch_size)
+
+    def __iter__(self):
+        order = torch.as_tensor(list(self.sampler), dtype=torch.long)
+        indices = order if self.indices is None else self.indices[order]
+        for batch_indices in indices.split(self.batch_size):
+            with record_function("data_loading"):
+                batch = self.dataset.get_batch(batch_indices)
+            yield batch
+
+
 class Trainer:
     def __init__(self, config: TrainConfigure):
         self.config = config
@@ -25,48 +79,79 @@ class Trainer:
         self.optimizer = torch.optim.AdamW(self.model.parameters(), lr=config.learning_rate)
         self.device = utils.get_auto_device() if config.device == "auto" else config.device
         self.model.to(self.device)
-        self._loss_history = []
-        self._validation_loader = None
+        self._evaluator = None
+        self._running_loss = {"epoch": 0.0}
+        self._resume_state = None
+        # with torchrun, every process trains on its shard of each batch and only rank 0 logs and saves
+        self.distributed = utils.init_distributed(config.distributed_backend)
+        self.is_main_process = utils.is_main_process()
+        self._checkpoint_writer = CheckpointWriter(
+            self.checkpoint_path, keep_last=config.keep_last_checkpoints, asynchronous=config.async_checkpointing
+        )
+        self.metrics = TrainingMetrics(self.checkpoint_path / "metrics.jsonl", num_processes=utils.get_world_size())
 
-    def _save_loss_history(self):
-        with open(self.checkpoint_path / "loss_history.txt", "a") as f:
-            f.write("\n".join(map(str, self._loss_history)) + "\n")
-        self._loss_history = []
+    def _save_checkpoint(self, file_name: str, epoch: int, batch_num: int, loss: float, lowest_loss: float):
+        # everything needed to resume training right after batch batch_num of epoch, snapshotted to the CPU
+        # here and written by the checkpoint writer's thread
+        self._checkpoint_writer.save(
+            {
+                "epoch": epoch,
+                "batch_num": batch_num,
+                "loss": loss,
+                "lowest_loss": lowest_loss,
+                "running_loss": dict(self._running_loss),
+                "rng_states": get_rng_states(),
+                "train_config": json.loads(self.config.json()),
+                "model_config": self.config.model_config.dict(),
+                "model_state_dict": self.model.state_dict(),
+                "optimizer_state_dict": self.optimizer.state_dict(),
+            },
+            file_name,
+        )
 
     def _save_model_if_best(self, epoch: int, batch_num: int, loss: float, lowest_loss: float):
+        saved_numbered = False
         if loss < lowest_loss or self.config.save_all_checkpoints:
-            lowest_loss = loss
-            self.checkpoint_path.mkdir(parents=True, exist_ok=True)
-            file_name = (
-                "best_model.ckpt" if self.config.overwrite_checkpoints else f"epoch_{epoch}_batch_{batch_num}.ckpt"
-            )
-            torch.save(
-                {
-                    "epoch": epoch,
-                    "batch_num": batch_num,
-                    "loss": loss,
-                    "train_config": self.config.dict(),
-                    "model_config": self.config.model_config.dict(),
-                    "model_state_dict": self.model.state_dict(),
-                    "optimizer_state_dict": self.optimizer.state_dict(),
-                },
-                self.checkpoint_path / file_name,
-            )
+            lowest_loss = min(loss, lowest_loss)
+            saved_numbered = not self.config.overwrite_checkpoints
+            file_name = f"epoch_{epoch}_batch_{batch_num}.ckpt" if saved_numbered else "best_model.ckpt"
+            self._save_checkpoint(file_name, epoch, batch_num, loss, lowest_loss)
+        if self.config.keep_last_checkpoints is not None and not saved_numbered:
+            # rolling resume points, of which the checkpoint writer keeps the last keep_last_checkpoints. a numbered
+            # best checkpoint is already a resume point for this batch
+            self._save_checkpoint(f"resume_epoch_{epoch}_batch_{batch_num}.ckpt", epoch, batch_num, loss, lowest_loss)
         return lowest_loss
 
-    @torch.no_grad()
-    def _print_epoch_loss(self, epoch: int, average_train_loss: float):
-        if self._validation_loader is None:
+    def _autocast(self):
+        if self.config.precision == "bf16":
+            return torch.autocast(device_type=torch.device(self.device).type, dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    def _optimizer_step(self):
+        if self.config.max_grad_norm is not None:
+            torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.config.max_grad_norm)
+        self.optimizer.step()
+        self.optimizer.zero_grad(set_to_none=True)
+
+    def _validation_loss(self):
+        return None if self._evaluator is None else self._evaluator.evaluate(self.model)
+
+    def _log_interval(self, progress_bar, summary, epoch, batch_num, step, average_loss, valid_loss):
+        # the loss of the summary is this process's, average_loss is the mean over all processes
+        summary = {**summary, "loss": average_loss, "validation_loss": valid_loss}
+        self.metrics.log("interval", epoch=epoch, batch=batch_num, step=step, **summary)
+        if self.config.progress_metrics:
+            # a rolling summary of the last eval interval next to the progress bar
+            progress_bar.set_description(
+                f"Training for {self.config.num_epochs} epochs  |  "
+                f"{summary['tokens_per_sec']:,.0f} tokens/sec  |  "
+                f"data wait {1000 * summary['data_wait']:.1f} ms/step"
+            )
+
+    def _print_epoch_loss(self, epoch: int, average_train_loss: float, average_valid_loss: Optional[float]):
+        if average_valid_loss is None:
             tqdm.write(f"***** epoch: {epoch} complete  ->  average train loss: {average_train_loss:<.4f} *****")
         else:
-            self.model.eval()
-            average_valid_loss = 0.0
-            for _ in range(self.config.batches_per_eval):
-                x, y = next(iter(self._validation_loader))
-                x, y = x.to(self.device), y.to(self.device)
-                _, loss = self.model(x, y)
-                average_valid_loss += loss.item() / self.config.batches_per_eval
-            self.model.train()
             tqdm.write(
                 f"***** epoch: {epoch}  complete  ->  "
                 f"average train loss: {average_train_loss:<.4f}  |  "
@@ -81,68 +166,167 @@ class Trainer:
         if context_length != self.config.context_length:
             raise ValueError(f"{name} {context_length=} does not match {self.config.context_length=}")
 
+    def _make_loader(self, dataset: DatasetType, shuffle: bool):
+        sampler = _EpochSampler(dataset, shuffle=shuffle, seed=self.config.data_seed)
+        base_dataset = dataset.dataset if isinstance(dataset, Subset) else dataset
+        if hasattr(base_dataset, "get_batch"):
+            return _BatchLoader(dataset, batch_size=self.config.batch_size, sampler=sampler)
+        return DataLoader(dataset=dataset, batch_size=self.config.batch_size, sampler=sampler)
+
+    def _resume(self, progress_bar):
+        # the epoch and batch to continue from, restoring the generators as they were when checkpointing
+        if self._resume_state is None:
+            return 1, 0
+        epoch, batch_num = self._resume_state["epoch"], self._resume_state["batch_num"]
+        self._running_loss = dict(self._resume_state["running_loss"])
+        set_rng_states(self._resume_state["rng_states"])
+        if batch_num >= len(self.train_loader):
+            epoch, batch_num = epoch + 1, 0
+        progress_bar.update((epoch - 1) * len(self.train_loader) + batch_num)
+        return epoch, batch_num
+
+    @contextlib.contextmanager
+    def _wait_for_checkpoints(self):
+        try:
+            yield
+        finally:
+            self._checkpoint_writer.wait()
+
+    def _profile(self):
+        # a bounded window of training steps, traced into the checkpoint directory by the main process
+        if not (self.config.profile and self.is_main_process):
+            return contextlib.nullcontext()
+        return profiling.profile(
+            self.checkpoint_path / "profile",
+            wait=self.config.profile_wait,
+            warmup=self.config.profile_warmup,
+            active=self.config.profile_active,
+        )
+
+    def _mean_over_processes(self, value: float):
+        if not self.distributed:
+            return value
+        value = torch.tensor(value, dtype=torch.float64)
+        dist.all_reduce(value)
+        return value.item() / dist.get_world_size()
+
     @classmethod
-    def from_checkpoint(cls, path: Union[str, Path]):
-        checkpoint = torch.load(path)
-        model_config = checkpoint["model_config"]
-        model = GPT(ModelConfigure(**model_config))
-        model.load_state_dict(checkpoint["model_state_dict"])
-        model.to(utils.get_auto_device() if model_config["device"] == "auto" else model_config["device"])
+    def from_checkpoint(cls, path: Union[str, Path], weights_only: bool = True):
+        """
+        Restore a trainer from a checkpoint, so that train continues right after the checkpointed batch.
+
+        :param weights_only: Load with torch.load's weights_only unpickler. Checkpoints written before train_config
+            was stored as plain JSON need False, which should only be used for trusted files.
+        """
+        checkpoint = torch.load(path, map_location="cpu", weights_only=weights_only)
         trainer = cls(TrainConfigure(**checkpoint["train_config"]))
-        trainer.model = model
+        trainer.model.load_state_dict(checkpoint["model_state_dict"])
         trainer.loss = checkpoint["loss"]
         trainer.optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
+        if "rng_states" in checkpoint:
+            trainer._resume_state = {
+                key: checkpoint[key] for key in ("epoch", "batch_num", "lowest_loss", "running_loss", "rng_states")
+            }
         return trainer
 
+    @staticmethod
+    def latest_checkpoint(checkpoint_path: Union[str, Path]) -> Optional[Path]:
+        """The most recent numbered checkpoint (a best or resume_ epoch_<epoch>_batch_<batch>.ckpt) in a directory."""
+        checkpoints = list_checkpoints(checkpoint_path)
+        return checkpoints[-1] if checkpoints else None
+
     def train(self, dataset: DatasetType, validation_dataset: Optional[DatasetType] = None, shuffle: bool = True):
         self._check_context_length(dataset, "training dataset")
-        self.train_loader = DataLoader(dataset=dataset, batch_size=self.config.batch_size, shuffle=shuffle)
+        self.train_loader = self._make_loader(dataset, shuffle=shuffle)
         total_iterations = self.config.num_epochs * len(self.train_loader)
         if validation_dataset is not None:
             self._check_context_length(validation_dataset, "validation dataset")
-            self._validation_loader = DataLoader(
-                dataset=validation_dataset, batch_size=self.config.batch_size, shuffle=True
+            # a fixed subset of batches_per_eval batches, scored in large batches at every eval interval
+            self._evaluator = Evaluator(
+                validation_dataset,
+                num_samples=self.config.batches_per_eval * self.config.batch_size * utils.get_world_size(),
+                batch_size=self.config.eval_batch_size or 4 * self.config.batch_size,
+                device=self.device,
+                seed=self.config.eval_seed,
+                autocast=self._autocast,
             )
 
-        with tqdm(total=total_iterations, desc=f"Training for {self.config.num_epochs} epochs:") as progress_bar:
+        # gradients are all-reduced across processes by DistributedDataParallel during backward
+        train_model = DistributedDataParallel(self.model) if self.distributed else self.model
+        progress_bar = tqdm(
+            total=total_iterations,
+            desc=f"Training for {self.config.num_epochs} epochs:",
+            disable=not self.is_main_process,
+        )
+        with progress_bar, self._wait_for_checkpoints(), self._profile():
 
             self.model.train()
             lowest_loss = float("inf")
+            accumulation_steps = self.config.gradient_accumulation_steps
+            self.optimizer.zero_grad(set_to_none=True)
+            start_epoch, start_batch = self._resume(progress_bar)
+            if self._resume_state is not None:
+                lowest_loss = self._resume_state["lowest_loss"]
 
-            for epoch in range(1, self.config.num_epochs + 1):
-                running_loss = {"epoch": 0.0, "batch_interval": 0.0}
-                for batch_num, (x, y) in enumerate(self.train_loader, start=1):
+            for epoch in range(start_epoch, self.config.num_epochs + 1):
+                first_batch = start_batch if epoch == start_epoch else 0
+                self.train_loader.sampler.set_epoch(epoch, start=first_batch * self.config.batch_size)
+                if first_batch == 0:
+                    self._running_loss = {"epoch": 0.0}
+                self.metrics.restart_clock()
+                for batch_num, (x, y) in enumerate(self.train_loader, start=first_batch + 1):
+                    step = (epoch - 1) * len(self.train_loader) + batch_num
+                    self.metrics.begin_step(epoch=epoch, batch=batch_num, step=step)
                     x, y = x.to(self.device), y.to(self.device)
+                    is_step = batch_num % accumulation_steps == 0 or batch_num == len(self.train_loader)
+                    # the last window of an epoch can be shorter, its gradient is still the mean over its micro-batches
+                    window_start = (batch_num - 1) // accumulation_steps * accumulation_steps
+                    window_size = min(accumulation_steps, len(self.train_loader) - window_start)
 
-                    # perform forward pass
-                    _, self.loss = self.model(x, y)
+                    # skip the gradient all-reduce on micro-batches that don't step the optimizer
+                    with train_model.no_sync() if self.distributed and not is_step else contextlib.nullcontext():
+                        # perform forward pass
+                        with self.metrics.time("forward"), self._autocast():
+                            _, self.loss = train_model(x, y)
 
-                    # perform backpropagation
-                    self.optimizer.zero_grad(set_to_none=True)
-                    self.loss.backward()
-                    self.optimizer.step()
+                        # perform backpropagation, stepping once every accumulation_steps micro-batches
+                        with self.metrics.time("backward"):
+                            (self.loss / window_size).backward()
+                    if is_step:
+                        with self.metrics.time("optimizer"):
+                            self._optimizer_step()
 
-                    # update loss logging variables
-                    running_loss["epoch"] += self.loss.item()
-                    running_loss["batch_interval"] += self.loss.item()
-                    self._loss_history.append(self.loss.item())
+                    # losses stay on the device, they are only read back at eval intervals and epoch ends
+                    self.metrics.end_step(self.loss, num_tokens=x.numel())
+                    self._running_loss["epoch"] = self._running_loss["epoch"] + self.loss.detach()
 
-                    # log average batch loss and save checkpoint if at eval interval
+                    # log average batch and validation loss and save checkpoint if at eval interval
                     if batch_num % self.config.eval_interval == 0:
-                        average_loss = running_loss["batch_interval"] / self.config.eval_interval
-                        running_loss["batch_interval"] = 0.0
-                        tqdm.write(
-                            f"epoch: {epoch:<4.0f}  |  "
-                            f"batch: {batch_num:<7.0f}  |  "
-                            f"average batch loss: {average_loss:<.4f}"
-                        )
-                        lowest_loss = self._save_model_if_best(epoch, batch_num, average_loss, lowest_loss)
-                        self._save_loss_history()
+                        summary = self.metrics.flush(write=self.is_main_process)
+                        average_loss = self._mean_over_processes(summary["loss"])
+                        valid_loss = self._validation_loss()
+                        if self.is_main_process:
+                            tqdm.write(
+                                f"epoch: {epoch:<4.0f}  |  "
+                                f"batch: {batch_num:<7.0f}  |  "
+                                f"average batch loss: {average_loss:<.4f}"
+                                + ("" if valid_loss is None else f"  |  validation loss: {valid_loss:<.4f}")
+                            )
+                            self._log_interval(progress_bar, summary, epoch, batch_num, step, average_loss, valid_loss)
+                            # checkpoints are selected by validation loss when there is a validation set
+                            selection_loss = average_loss if valid_loss is None else valid_loss
+                            lowest_loss = self._save_model_if_best(epoch, batch_num, selection_loss, lowest_loss)
+                        self.metrics.restart_clock()
 
                     progress_bar.update(1)
+                    profiling.profiler_step()
 
                 # log epoch loss and save checkpoint
-                average_loss = running_loss["epoch"] / len(self.train_loader)
-                self._print_epoch_loss(epoch, average_loss)
-                lowest_loss = self._save_model_if_best(epoch, batch_num, average_loss, lowest_loss)
-                self._save_loss_history()
+                self.metrics.flush(write=self.is_main_process)
+                average_loss = self._mean_over_processes(float(self._running_loss["epoch"]) / len(self.train_loader))
+                valid_loss = self._validation_loss()
+                if self.is_main_process:
+                    self._print_epoch_loss(epoch, average_loss, valid_loss)
+                    self.metrics.log("epoch", epoch=epoch, step=step, loss=average_loss, validation_loss=valid_loss)
+                    selection_loss = average_loss if valid_loss is None else valid_loss
+                    lowest_loss = self._save_model_if_best(epoch, batch_num, selection_loss, lowest_loss)
@@ -1,6 +1,12 @@
+import contextlib
+import os
+from pathlib import Path
+from typing import Union
+
 import torch
+import torch.distributed as dist
 
-__all__ = ["get_auto_device"]
+__all__ = ["atomic_save", "get_auto_device", "get_rank", "get_world_size", "init_distributed", "is_main_process"]
 
 
 def get_auto_device():
@@ -11,3 +17,41 @@ def get_auto_device():
     else:
         device = "cpu"
     return device
+
+
+def init_distributed(backend="gloo"):
+    """Join the process group when launched by torchrun with more than one process, returns whether it did."""
+    if int(os.environ.get("WORLD_SIZE", 1)) <= 1:
+        return False
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend)
+    return True
+
+
+def get_rank():
+    return dist.get_rank() if dist.is_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+@contextlib.contextmanager
+def atomic_save(path: Union[str, Path]):
+    """
+    Open a temporary file next to path for binary writing and rename it to path once the block completes, so
+    readers (including other processes) never see a partially written file. On error the temporary file is removed.
+    """
+    path = Path(path)
+    temporary_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(temporary_path, "wb") as f:
+            yield f
+        os.replace(temporary_path, path)
+    finally:
+        if temporary_path.exists():
+            temporary_path.unlink()
@@ -1,7 +1,9 @@
 from __future__ import annotations
-import collections
+import functools
 from math import sqrt
+from typing import Union
 
+import numpy as np
 import scipy.stats
 
 import torch
@@ -9,6 +11,35 @@ from torch import Tensor
 
 
 
+def _greenlist_row(
+    vocab_size: int, gamma: float, hash_key: int, select_green_tokens: bool, prev_token: int
+) -> torch.BoolTensor:
+    """(vocab_size,) mask of the simple_1 greenlist induced by prev_token.
+
+    Drawn with the same CPU generator seeding and randperm call as WatermarkBase._get_greenlist_ids,
+    so it is bit-identical to the greenlists computed one token at a time.
+    """
+    rng = torch.Generator(device="cpu")
+    rng.manual_seed(hash_key * prev_token)
+    greenlist_size = int(vocab_size * gamma)
+    vocab_permutation = torch.randperm(vocab_size, generator=rng)
+    if select_green_tokens:  # directly
+        greenlist_ids = vocab_permutation[:greenlist_size]
+    else:  # select green via red
+        greenlist_ids = vocab_permutation[(vocab_size - greenlist_size) :]
+    greenlist_mask = torch.zeros(vocab_size, dtype=torch.bool)
+    greenlist_mask[greenlist_ids] = True
+    return greenlist_mask
+
+
+@functools.lru_cache(maxsize=32)
+def _greenlist_table(vocab_size: int, gamma: float, hash_key: int, select_green_tokens: bool) -> torch.BoolTensor:
+    """(vocab_size, vocab_size) mask whose row p is the simple_1 greenlist induced by the previous token p."""
+    return torch.stack(
+        [_greenlist_row(vocab_size, gamma, hash_key, select_green_tokens, p) for p in range(vocab_size)]
+    )
+
+
 class WatermarkBase:
     def __init__(
         self,
@@ -28,6 +59,7 @@ class WatermarkBase:
         self.rng = None
         self.hash_key = hash_key
         self.select_green_tokens = select_green_tokens
+        self._greenlist_tables = {}
 
     def _seed_rng(self, input_ids: torch.LongTensor, seeding_scheme: str = None) -> None:
         # can optionally override the seeding scheme,
@@ -56,44 +88,135 @@ class WatermarkBase:
             greenlist_ids = vocab_permutation[(self.vocab_size - greenlist_size) :]  # legacy behavior
         return greenlist_ids
 
+    def _get_greenlist_table(self, device: torch.device) -> torch.BoolTensor:
+        # the simple_1 greenlist only depends on the previous token, so all greenlists
+        # fit in a single vocab_size x vocab_size table, kept on each device it is used on
+        if self.seeding_scheme != "simple_1":
+            raise NotImplementedError(f"Unexpected seeding_scheme: {self.seeding_scheme}")
+        device = torch.device(device)
+        if device not in self._greenlist_tables:
+            table = _greenlist_table(self.vocab_size, self.gamma, self.hash_key, self.select_green_tokens)
+            self._greenlist_tables[device] = table.to(device)
+        return self._greenlist_tables[device]
+
+    def _get_greenlist_masks(self, prev_tokens: torch.LongTensor) -> torch.BoolTensor:
+        # (..., vocab_size) greenlist masks induced by each of the (...) previous tokens
+        greenlist_table = self._get_greenlist_table(prev_tokens.device)
+        in_vocab = (prev_tokens >= 0) & (prev_tokens < self.vocab_size)
+        greenlist_masks = greenlist_table[torch.where(in_vocab, prev_tokens, 0)]
+        if not in_vocab.all():
+            # tokens outside of the vocabulary (e.g. notes decoded from noisy audio) still seed the rng
+            for prev_token in prev_tokens[~in_vocab].unique().tolist():
+                greenlist_row = _greenlist_row(
+                    self.vocab_size, self.gamma, self.hash_key, self.select_green_tokens, prev_token
+                )
+                greenlist_masks[prev_tokens == prev_token] = greenlist_row.to(prev_tokens.device)
+        return greenlist_masks
+
 
 class WatermarkLogitsProcessor(WatermarkBase):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-    def _calc_greenlist_mask(self, scores: torch.FloatTensor, greenlist_token_ids) -> torch.BoolTensor:
-        # TODO lets see if we can lose this loop
-        green_tokens_mask = torch.zeros_like(scores)
-        for b_idx in range(len(greenlist_token_ids)):
-            green_tokens_mask[b_idx][greenlist_token_ids[b_idx]] = 1
-        final_mask = green_tokens_mask.bool()
-        return final_mask
-
     def _bias_greenlist_logits(self, scores: torch.Tensor, greenlist_mask: torch.Tensor, greenlist_bias: float) -> torch.Tensor:
         scores[greenlist_mask] = scores[greenlist_mask] + greenlist_bias
         return scores
 
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        assert input_ids.shape[-1] >= 1, "seeding_scheme=simple_1 requires at least a 1 token prefix sequence"
+        # the greenlists of the whole batch are one lookup into the greenlist table,
+        # which lives on the device of the scores, so no host round-trip is needed
+        green_tokens_mask = self._get_greenlist_masks(input_ids[:, -1].to(scores.device))
 
-        # this is lazy to allow us to colocate on the watermarked model's device
-        if self.rng is None:
-            self.rng = torch.Generator(device=input_ids.device)
+        scores = self._bias_greenlist_logits(scores=scores, greenlist_mask=green_tokens_mask, greenlist_bias=self.delta)
+        return scores
 
-        # NOTE, it would be nice to get rid of this batch loop, but currently,
-        # the seed and partition operations are not tensor/vectorized, thus
-        # each sequence in the batch needs to be treated separately.
-        batched_greenlist_ids = [None for _ in range(input_ids.shape[0])]
 
-        for b_idx in range(input_ids.shape[0]):
-            greenlist_ids = self._get_greenlist_ids(input_ids[b_idx])
-            batched_greenlist_ids[b_idx] = greenlist_ids
 
-        green_tokens_mask = self._calc_greenlist_mask(scores=scores, greenlist_token_ids=batched_greenlist_ids)
 
-        scores = self._bias_greenlist_logits(scores=scores, greenlist_mask=green_tokens_mask, greenlist_bias=self.delta)
-        return scores
+def _adjust_p_values(p_values: np.ndarray, correction: str) -> np.ndarray:
+    # multiple-testing adjusted p-values, to be compared against a family-wise (or false discovery) rate
+    num_tests = len(p_values)
+    if correction == "bonferroni":
+        return np.minimum(1.0, num_tests * p_values)
+    order = np.argsort(p_values)
+    sorted_p_values = p_values[order]
+    if correction == "holm":
+        adjusted = np.maximum.accumulate((num_tests - np.arange(num_tests)) * sorted_p_values)
+    elif correction == "benjamini-hochberg":
+        adjusted = np.minimum.accumulate((num_tests / np.arange(1, num_tests + 1) * sorted_p_values)[::-1])[::-1]
+    else:
+        raise NotImplementedError(f"Unexpected correction: {correction}")
+    adjusted_p_values = np.empty_like(p_values)
+    adjusted_p_values[order] = np.minimum(1.0, adjusted)
+    return adjusted_p_values
 
 
+class WatermarkKeyRegistry:
+    """Named (hash_key, gamma) watermark configurations that share a vocabulary.
+
+    The greenlist tables of the first max_cached_tables configurations used are cached. Other keys are scored
+    from the greenlist rows of the distinct previous tokens of each sequence alone, and keys are scored in groups
+    of at most max_cached_tables, so memory stays bounded however many keys are registered.
+    """
+
+    def __init__(self, vocab_size: int = 47, select_green_tokens: bool = True, max_cached_tables: int = 256):
+        self.vocab_size = vocab_size
+        self.select_green_tokens = select_green_tokens
+        self.max_cached_tables = max_cached_tables
+        self._keys = {}
+        self._tables = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    @property
+    def names(self) -> list[str]:
+        return list(self._keys)
+
+    def register(self, name: str, hash_key: int, gamma: float = 0.25):
+        self._keys[name] = (hash_key, gamma)
+
+    def unregister(self, name: str):
+        config = self._keys.pop(name)
+        if config not in self._keys.values():
+            self._tables.pop(config, None)
+
+    def _greenlist_rows(self, hash_key: int, gamma: float, prev_tokens: torch.LongTensor) -> torch.BoolTensor:
+        # (U, vocab_size) greenlists induced by each of the U (CPU) previous tokens
+        config = (hash_key, gamma)
+        if config not in self._tables and len(self._tables) < self.max_cached_tables:
+            # bypass the module-level cache so that this registry alone bounds the memory used
+            self._tables[config] = _greenlist_table.__wrapped__(
+                self.vocab_size, gamma, hash_key, self.select_green_tokens
+            )
+        in_vocab = (prev_tokens >= 0) & (prev_tokens < self.vocab_size)
+        rows = torch.empty((len(prev_tokens), self.vocab_size), dtype=torch.bool)
+        if config in self._tables:
+            rows[in_vocab] = self._tables[config][prev_tokens[in_vocab]]
+        else:
+            in_vocab = torch.zeros_like(in_vocab)
+        # tokens outside of the vocabulary (e.g. notes decoded from noisy audio) still seed the rng
+        for i in torch.nonzero(~in_vocab)[:, 0].tolist():
+            rows[i] = _greenlist_row(self.vocab_size, gamma, hash_key, self.select_green_tokens, int(prev_tokens[i]))
+        return rows
+
+    def green_token_masks(self, input_ids: torch.LongTensor) -> torch.BoolTensor:
+        """(num_keys, T - 1) masks of the tokens that fall in each key's simple_1 greenlist."""
+        assert len(self._keys) > 0, "No watermark keys are registered"
+        prev_tokens, curr_tokens = input_ids[:-1], input_ids[1:]
+        curr_in_vocab = (curr_tokens >= 0) & (curr_tokens < self.vocab_size)
+        curr_tokens = torch.where(curr_in_vocab, curr_tokens, 0)
+        unique_prev_tokens, prev_indices = prev_tokens.cpu().unique(return_inverse=True)
+        prev_indices = prev_indices.to(input_ids.device)
+        configs = list(self._keys.values())
+        green_token_masks = torch.empty((len(configs), len(prev_tokens)), dtype=torch.bool, device=input_ids.device)
+        for start in range(0, len(configs), self.max_cached_tables):
+            group = configs[start : start + self.max_cached_tables]
+            # (keys, U, vocab_size) rows of the distinct previous tokens only
+            rows = torch.stack([self._greenlist_rows(*config, unique_prev_tokens) for config in group])
+            green_token_masks[start : start + len(group)] = rows.to(input_ids.device)[:, prev_indices, curr_tokens]
+        return green_token_masks & curr_in_vocab
 
 
 class WatermarkDetector(WatermarkBase):
@@ -127,6 +250,14 @@ class WatermarkDetector(WatermarkBase):
         if self.ignore_repeated_bigrams:
             assert self.seeding_scheme == "simple_1", "No repeated bigram credit variant assumes the single token seeding scheme."
 
+    def _green_token_mask(self, input_ids: torch.LongTensor) -> torch.BoolTensor:
+        # (..., T - 1) mask of the tokens that fall in the greenlist induced by their previous token
+        curr_tokens = input_ids[..., self.min_prefix_len :]
+        greenlist_masks = self._get_greenlist_masks(input_ids[..., : -self.min_prefix_len])
+        in_vocab = (curr_tokens >= 0) & (curr_tokens < self.vocab_size)
+        curr_tokens = torch.where(in_vocab, curr_tokens, 0)
+        return greenlist_masks.gather(-1, curr_tokens[..., None])[..., 0] & in_vocab
+
     def _compute_z_score(self, observed_count, T):
         # count refers to number of green tokens, T is total number of tokens
         expected_count = self.gamma
@@ -162,19 +293,11 @@ class WatermarkDetector(WatermarkBase):
                 )
             # Standard method.
             # Since we generally need at least 1 token (for the simplest scheme)
-            # we start the iteration over the token sequence with a minimum
-            # num tokens as the first prefix for the seeding scheme,
-            # and at each step, compute the greenlist induced by the
-            # current prefix and check if the current token falls in the greenlist.
-            green_token_count, green_token_mask = 0, []
-            for idx in range(self.min_prefix_len, len(input_ids)):
-                curr_token = input_ids[idx]
-                greenlist_ids = self._get_greenlist_ids(input_ids[:idx])
-                if curr_token in greenlist_ids:
-                    green_token_count += 1
-                    green_token_mask.append(True)
-                else:
-                    green_token_mask.append(False)
+            # we start with a minimum num tokens as the first prefix for the seeding scheme,
+            # and check for every later token if it falls in the greenlist induced by its prefix.
+            green_token_mask = self._green_token_mask(torch.as_tensor(input_ids, device=self.device))
+            green_token_count = int(green_token_mask.sum())
+            green_token_mask = green_token_mask.tolist()
 
         score_dict = dict()
         if return_num_tokens_scored:
@@ -231,4 +354,218 @@ class WatermarkDetector(WatermarkBase):
             if output_dict["prediction"]:
                 output_dict["confidence"] = 1 - score_dict["p_value"]
 
-        return output_dict
\ No newline at end of file
+        return output_dict
+
+    def detect_keys(
+        self,
+        registry: WatermarkKeyRegistry,
+        text: torch.tensor = None,
+        tokenized_text: list[int] = None,
+        correction: str = "holm",
+        z_threshold: float = None,
+    ) -> dict:
+        """Score one sequence against every key of the registry in a single vectorized pass.
+
+        A key is detected when its p-value, adjusted for testing all registered keys with the "bonferroni",
+        "holm" or "benjamini-hochberg" correction, is below the one-sided p-value of z_threshold.
+        """
+        assert (text is not None) ^ (tokenized_text is not None), "Must pass either the raw or tokenized string"
+        assert registry.vocab_size == self.vocab_size, f"{registry.vocab_size=} does not match {self.vocab_size=}"
+        if tokenized_text is None:
+            tokenized_text = self.tokenizer.encode(text.flatten())
+        input_ids = torch.as_tensor(tokenized_text, dtype=torch.long, device=self.device).flatten()
+        num_tokens_scored = len(input_ids) - self.min_prefix_len
+        if num_tokens_scored < 1:
+            raise ValueError(
+                (
+                    f"Must have at least {1} token to score after "
+                    f"the first min_prefix_len={self.min_prefix_len} tokens required by the seeding scheme."
+                )
+            )
+
+        num_green_tokens = registry.green_token_masks(input_ids).sum(dim=1).cpu().numpy()
+        gammas = np.array([gamma for _, gamma in registry._keys.values()])
+        z_score = (num_green_tokens - gammas * num_tokens_scored) / np.sqrt(num_tokens_scored * gammas * (1 - gammas))
+        p_value = self._compute_p_value(z_score)
+        adjusted_p_value = _adjust_p_values(p_value, correction)
+        z_threshold = z_threshold if z_threshold else self.z_threshold
+        prediction = adjusted_p_value < self._compute_p_value(z_threshold)
+        return dict(
+            key_names=registry.names,
+            num_tokens_scored=num_tokens_scored,
+            num_green_tokens=num_green_tokens,
+            green_fraction=num_green_tokens / num_tokens_scored,
+            z_score=z_score,
+            p_value=p_value,
+            adjusted_p_value=adjusted_p_value,
+            prediction=prediction,
+            detected_keys=[name for name, detected in zip(registry.names, prediction) if detected],
+        )
+
+    def detect_batch(
+        self,
+        texts: list[torch.tensor] = None,
+        tokenized_texts: Union[list[list[int]], torch.LongTensor] = None,
+        lengths: list[int] = None,
+        return_prediction: bool = True,
+        z_threshold: float = None,
+    ) -> dict:
+        """Score many sequences in one vectorized pass.
+
+        Takes a list of raw or tokenized sequences of any lengths, or a right-padded (B, T) tensor of
+        tokenized sequences together with their lengths. Returns a dict of per-sequence numpy arrays with
+        the same score keys as detect.
+        """
+        assert (texts is not None) ^ (tokenized_texts is not None), "Must pass either the raw or tokenized strings"
+        if self.ignore_repeated_bigrams:
+            raise NotImplementedError
+
+        if texts is not None:
+            tokenized_texts = [self.tokenizer.encode(text.flatten()) for text in texts]
+        if isinstance(tokenized_texts, torch.Tensor) and tokenized_texts.dim() == 2:
+            input_ids = tokenized_texts.to(self.device)
+            if lengths is None:
+                lengths = [input_ids.shape[1]] * input_ids.shape[0]
+        else:
+            tokenized_texts = [torch.as_tensor(t, dtype=torch.long).flatten() for t in tokenized_texts]
+            lengths = [len(t) for t in tokenized_texts]
+            input_ids = torch.nn.utils.rnn.pad_sequence(tokenized_texts, batch_first=True).to(self.device)
+        lengths = torch.as_tensor(lengths, device=self.device)
+
+        num_tokens_scored = lengths - self.min_prefix_len
+        if (num_tokens_scored < 1).any():
+            raise ValueError(
+                (
+                    f"Must have at least {1} token to score after "
+                    f"the first min_prefix_len={self.min_prefix_len} tokens required by the seeding scheme."
+                )
+            )
+        positions = torch.arange(self.min_prefix_len, input_ids.shape[1], device=self.device)
+        green_token_mask = self._green_token_mask(input_ids) & (positions < lengths[:, None])
+
+        num_tokens_scored = num_tokens_scored.cpu().numpy()
+        num_green_tokens = green_token_mask.sum(dim=1).cpu().numpy()
+        z_score = (num_green_tokens - self.gamma * num_tokens_scored) / np.sqrt(
+            num_tokens_scored * self.gamma * (1 - self.gamma)
+        )
+        output_dict = dict(
+            num_tokens_scored=num_tokens_scored,
+            num_green_tokens=num_green_tokens,
+            green_fraction=num_green_tokens / num_tokens_scored,
+            z_score=z_score,
+            p_value=self._compute_p_value(z_score),
+        )
+        if return_prediction:
+            z_threshold = z_threshold if z_threshold else self.z_threshold
+            assert z_threshold is not None, "Need a threshold in order to decide outcome of detection test"
+            output_dict["prediction"] = z_score > z_threshold
+        return output_dict
+
+class StreamingWatermarkDetector(WatermarkDetector):
+    """Watermark detector that is fed tokens as they arrive.
+
+    Keeps prefix sums of the green token counts, so the global score, the max-z windows of any size and the
+    most likely watermarked segments are available in O(n) at any time without re-scoring the history.
+    Positions are indices into the stream of tokens passed to update, with half-open [start, end) segments.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reset()
+
+    def reset(self):
+        self._prefix = torch.zeros(0, dtype=torch.long, device=self.device)
+        # _green_prefix_sums[i] is the number of green tokens among the first i scored tokens
+        self._green_prefix_sums = np.zeros(1024, dtype=np.int64)
+        self.num_tokens_scored = 0
+
+    @property
+    def green_prefix_sums(self) -> np.ndarray:
+        return self._green_prefix_sums[: self.num_tokens_scored + 1]
+
+    def update(self, text: torch.tensor = None, tokenized_text: list[int] = None) -> int:
+        """Score newly arrived tokens and return the total number of tokens scored so far."""
+        assert (text is not None) ^ (tokenized_text is not None), "Must pass either the raw or tokenized string"
+        if tokenized_text is None:
+            tokenized_text = self.tokenizer.encode(text.flatten())
+        tokens = torch.as_tensor(tokenized_text, dtype=torch.long, device=self.device).flatten()
+        tokens = torch.cat((self._prefix, tokens))
+        if len(tokens) > self.min_prefix_len:
+            green_token_mask = self._green_token_mask(tokens).cpu().numpy()
+            end = self.num_tokens_scored + 1 + len(green_token_mask)
+            if end > len(self._green_prefix_sums):
+                self._green_prefix_sums = np.resize(self._green_prefix_sums, max(end, 2 * len(self._green_prefix_sums)))
+            self._green_prefix_sums[self.num_tokens_scored + 1 : end] = self._green_prefix_sums[
+                self.num_tokens_scored
+            ] + np.cumsum(green_token_mask)
+            self.num_tokens_scored += len(green_token_mask)
+        self._prefix = tokens[-self.min_prefix_len :]
+        return self.num_tokens_scored
+
+    def _score_span(self, start, end) -> dict:
+        # start and end index scored tokens; arrays of spans are scored elementwise
+        num_tokens_scored = end - start
+        num_green_tokens = self._green_prefix_sums[end] - self._green_prefix_sums[start]
+        z_score = (num_green_tokens - self.gamma * num_tokens_scored) / np.sqrt(
+            num_tokens_scored * self.gamma * (1 - self.gamma)
+        )
+        return dict(
+            start=start + self.min_prefix_len,
+            end=end + self.min_prefix_len,
+            num_tokens_scored=num_tokens_scored,
+            num_green_tokens=num_green_tokens,
+            z_score=z_score,
+            p_value=self._compute_p_value(z_score),
+        )
+
+    def score(self, return_prediction: bool = True, z_threshold: float = None) -> dict:
+        """Score of all the tokens seen so far, with the same keys as WatermarkDetector.detect."""
+        if self.num_tokens_scored < 1:
+            raise ValueError(
+                (
+                    f"Must have at least {1} token to score after "
+                    f"the first min_prefix_len={self.min_prefix_len} tokens required by the seeding scheme."
+                )
+            )
+        num_green_tokens = int(self._green_prefix_sums[self.num_tokens_scored])
+        output_dict = dict(
+            num_tokens_scored=self.num_tokens_scored,
+            num_green_tokens=num_green_tokens,
+            green_fraction=num_green_tokens / self.num_tokens_scored,
+            z_score=self._compute_z_score(num_green_tokens, self.num_tokens_scored),
+        )
+        output_dict["p_value"] = self._compute_p_value(output_dict["z_score"])
+        if return_prediction:
+            z_threshold = z_threshold if z_threshold else self.z_threshold
+            output_dict["prediction"] = output_dict["z_score"] > z_threshold
+            if output_dict["prediction"]:
+                output_dict["confidence"] = 1 - output_dict["p_value"]
+        return output_dict
+
+    def max_z_windows(self, window_sizes: list[int] = (16, 32, 64, 128)) -> list[dict]:
+        """The highest scoring window of every window size that fits in the tokens seen so far."""
+        windows = []
+        for window_size in window_sizes:
+            if window_size > self.num_tokens_scored:
+                continue
+            starts = np.arange(self.num_tokens_scored - window_size + 1)
+            num_green_tokens = self._green_prefix_sums[starts + window_size] - self._green_prefix_sums[starts]
+            best_start = int(np.argmax(num_green_tokens))
+            windows.append(dict(window_size=window_size, **self._score_span(best_start, best_start + window_size)))
+        return windows
+
+    def watermarked_segments(self, window_size: int = 32, z_threshold: float = None) -> list[dict]:
+        """Merge all windows of window_size whose z-score exceeds z_threshold into segments and score them."""
+        z_threshold = z_threshold if z_threshold else self.z_threshold
+        if window_size > self.num_tokens_scored:
+            return []
+        starts = np.arange(self.num_tokens_scored - window_size + 1)
+        window_z_scores = self._score_span(starts, starts + window_size)["z_score"]
+        flagged_starts = starts[window_z_scores > z_threshold]
+        if len(flagged_starts) == 0:
+            return []
+        # flagged windows that overlap or touch belong to the same segment
+        breaks = np.nonzero(np.diff(flagged_starts) > window_size)[0]
+        segment_starts = flagged_starts[np.r_[0, breaks + 1]]
+        segment_ends = flagged_starts[np.r_[breaks, len(flagged_starts) - 1]] + window_size
+        return [self._score_span(int(start), int(end)) for start, end in zip(segment_starts, segment_ends)]